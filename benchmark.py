@@ -0,0 +1,348 @@
+### PIPELINE BENCHMARKS AGAINST THE MOCK BULK 2.0 API
+# runs the main query, ingest and upload functions against mock_bulk_api.py with synthetic admin tool exports
+# reports wall time, peak process memory (RSS) and Python heap, API request counts and the timed spans of functions.py per phase,
+# and checks that a run resumed after a failure doesn't insert rescues twice
+# usage: python benchmark.py --sizes 10000 100000 1000000 --latency 0.01 --output bench.json
+
+from contextlib import redirect_stdout
+import pandas as pd
+import numpy as np
+import argparse
+import gc
+import subprocess
+import tempfile
+import tracemalloc
+import threading
+import socket
+import json
+import time
+import sys
+import os
+import io
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import functions
+
+# record type IDs used by the upload wrappers
+DONOR_TYPE = '0123t000000YYv2AAG'
+PARTNER_TYPE = '0123t000000YYv3AAG'
+
+# fraction of the synthetic admin accounts and volunteers that already exist in the mock org
+EXISTING_FRACTION = 0.9
+
+# helper function to find a free local port for the mock server
+def findFreePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# function to start mock_bulk_api.py in its own process, so its memory isn't counted in the benchmark
+# returns the process and the base url of the server
+def startMockServerProcess(latency, processingTime):
+    port = findFreePort()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_bulk_api.py')
+    process = subprocess.Popen([sys.executable, script, '--port', str(port), '--latency', str(latency), '--processing-time', str(processingTime)], stdout=subprocess.DEVNULL)
+    baseUrl = 'http://127.0.0.1:' + str(port)
+
+    # wait until the server accepts requests
+    for _ in range(100):
+        try:
+            requests.get(baseUrl + '/_stats')
+            return process, baseUrl
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Mock server did not start')
+
+# function to build synthetic admin tool exports for a given number of rescues, written to the current directory
+# returns the synthetic donor, partner and volunteer names so the org can be seeded with most of them
+def writeSyntheticExports(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    numDonors = max(50, rows // 200)
+    numPartners = max(20, rows // 500)
+    numVolunteers = max(50, rows // 100)
+
+    # donors and partners: every fifth location belongs to a parent chain
+    donorNames = np.array(['Donor Location ' + str(i) for i in range(numDonors)], dtype=object)
+    donorParents = np.where(np.arange(numDonors) % 5 == 0, donorNames, np.array(['Donor Chain ' + str(i // 5) for i in range(numDonors)], dtype=object))
+    pd.DataFrame({
+        'Name': donorParents, 'location_name': donorNames, 'line1': '1 Main St', 'city': 'Pittsburgh', 'state': 'PA',
+        'zip': rng.integers(15000, 16000, numDonors).astype(str), 'county': 'Allegheny'
+    }).to_csv('lastmile_donors.csv', index=False)
+
+    partnerNames = np.array(['Partner Location ' + str(i) for i in range(numPartners)], dtype=object)
+    pd.DataFrame({
+        'Name': partnerNames, 'location_name': partnerNames, 'line1': '2 Main St', 'city': 'Pittsburgh', 'state': 'PA',
+        'zip': rng.integers(15000, 16000, numPartners).astype(str)
+    }).to_csv('lastmile_partners.csv', index=False)
+
+    volunteerIds = np.arange(1, numVolunteers + 1)
+    firstNames = np.array(['First' + str(i) for i in volunteerIds], dtype=object)
+    lastNames = np.array(['Last' + str(i) for i in volunteerIds], dtype=object)
+    pd.DataFrame({
+        'user_id': volunteerIds, 'first_name': firstNames, 'last_name': lastNames, 'email': [str(i) + '@example.org' for i in volunteerIds],
+        'phone': rng.integers(4120000000, 4129999999, numVolunteers), 'address': '3 Main St', 'city': 'Pittsburgh', 'state': 'PA',
+        'zip': '15213', 'county': 'Allegheny', 'user_state': 'Active'
+    }).to_csv('lastmile_volunteers.csv', index=False)
+
+    # rescues: one row per (rescue, food type)
+    donorIdx = rng.integers(0, numDonors, rows)
+    partnerIdx = rng.integers(0, numPartners, rows)
+    volunteerIdx = rng.integers(0, numVolunteers, rows)
+    weights = rng.integers(1, 500, rows).astype(object)
+    weights[rng.random(rows) < 0.01] = 'Please assign weight'
+    pd.DataFrame({
+        'rescue_detail_url': ['https://admin.example.org/rescues/' + str(i) for i in range(rows)],
+        'rescue_id': np.arange(rows),
+        'pickup_start': pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D'),
+        'food_type': rng.choice(['Produce', 'Dairy', 'Bakery', 'Prepared', 'Meat'], rows),
+        'description': 'synthetic rescue',
+        'rescue_type': rng.choice(['one-time', 'recurring'], rows),
+        'rescue_state': rng.choice(['Complete', 'Canceled', 'Scheduled'], rows, p=[0.8, 0.1, 0.1]),
+        'county': 'Allegheny',
+        'donor_name': donorParents[donorIdx],
+        'recipient_name': partnerNames[partnerIdx],
+        'donor_location_name': donorNames[donorIdx],
+        'recipient_location_name': partnerNames[partnerIdx],
+        'volunteer': firstNames[volunteerIdx] + ' ' + lastNames[volunteerIdx],
+        'estimated_quantity': 1,
+        'reported_quantity': 1,
+        ' unit_weight ': 1,
+        ' total_weight ': weights,
+        'volunteer_id': volunteerIds[volunteerIdx]
+    }).to_csv('lastmile_rescues.csv')
+
+    return donorNames, donorParents, partnerNames, firstNames, lastNames
+
+# function to seed the mock org with the accounts, volunteers and rescues that "already exist" in Salesforce
+def seedMockOrg(baseUrl, rows, donorNames, partnerNames, firstNames, lastNames):
+    def seed(objectType, df):
+        requests.post(baseUrl + '/_seed', params={'object': objectType}, data=df.to_csv(index=False).encode('utf-8'))
+
+    requests.post(baseUrl + '/_reset')
+    existingDonors = donorNames[:int(len(donorNames) * EXISTING_FRACTION)]
+    existingPartners = partnerNames[:int(len(partnerNames) * EXISTING_FRACTION)]
+    seed('Account', pd.DataFrame({
+        'Name': np.concatenate([existingDonors, existingPartners]),
+        'RecordTypeId': [DONOR_TYPE] * len(existingDonors) + [PARTNER_TYPE] * len(existingPartners)
+    }))
+    numExistingVolunteers = int(len(firstNames) * EXISTING_FRACTION)
+    seed('Contact', pd.DataFrame({
+        'Name': firstNames[:numExistingVolunteers] + ' ' + lastNames[:numExistingVolunteers],
+        'Volunteer_Id__c': np.arange(1, numExistingVolunteers + 1)
+    }))
+    seed('Food_Rescue__c', pd.DataFrame({
+        'Rescue_Id__c': np.arange(rows), 'Food_Type__c': 'Produce', 'Weight__c': 10, 'State__c': 'completed',
+        'Day_of_Pickup__c': '2021-01-01', 'Rescue_Detail_URL__c': 'https://admin.example.org/rescues/0', 'Comments__c': ''
+    }))
+
+# seconds between samples of the process memory while a phase runs
+RSS_SAMPLE_INTERVAL = 0.01
+
+# function to read the resident memory (RSS) of this process in bytes, None where it can't be read
+# uses psutil if it is installed, otherwise /proc (Linux)
+def getResidentMemory():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+# context manager that samples the process memory in a background thread, filling in the peak RSS seen while it was open
+# (RSS includes the native buffers of numpy, Arrow and the sockets, which tracemalloc doesn't see)
+class ResidentMemorySampler:
+    def __enter__(self):
+        self.start = getResidentMemory()
+        self.peak = self.start
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stopped.wait(RSS_SAMPLE_INTERVAL):
+            rss = getResidentMemory()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        rss = getResidentMemory()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+# function to run one benchmark phase: returns wall time, peak process memory (RSS) and how much it grew during the phase,
+# peak Python heap (tracemalloc, Python objects only) and the API requests it made
+def measurePhase(name, baseUrl, phase):
+    before = requests.get(baseUrl + '/_stats').json()
+    functions.resetRunMetrics()
+    gc.collect()
+    with ResidentMemorySampler() as rss:
+        tracemalloc.start()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            phase()
+        wallSeconds = time.perf_counter() - start
+        _, peakHeap = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    after = requests.get(baseUrl + '/_stats').json()
+
+    requestCounts = {endpoint: count - before.get(endpoint, 0) for endpoint, count in after.items() if count != before.get(endpoint, 0)}
+    return {
+        'phase': name,
+        'wallSeconds': round(wallSeconds, 3),
+        'peakRssMB': round(rss.peak / 1e6, 1) if rss.peak is not None else None,
+        'rssGrowthMB': round((rss.peak - rss.start) / 1e6, 1) if rss.peak is not None else None,
+        'peakPythonHeapMB': round(peakHeap / 1e6, 1),
+        'requests': sum(requestCounts.values()),
+        'requestCounts': requestCounts,
+        'spans': functions.getRunReport()['summary']
+    }
+
+# function to run all phases for one export size
+def runBenchmark(rows, baseUrl):
+    uri = baseUrl + '/services/data/v52.0/jobs/'
+    session = functions.createBulkSession('benchmark-session')
+    donorNames, donorParents, partnerNames, firstNames, lastNames = writeSyntheticExports(rows)
+    seedMockOrg(baseUrl, rows, donorNames, partnerNames, firstNames, lastNames)
+    functions.clearQueryCache()
+    functions.clearNormalizedNamesCache()
+    results = []
+
+    # query: full extract of the rescues table
+    query = 'SELECT Id, Rescue_Id__c, Food_Type__c, Weight__c, State__c FROM Food_Rescue__c'
+    results.append(measurePhase('getDataframeFromSalesforce', baseUrl, lambda: functions.getDataframeFromSalesforce(query, session, uri)))
+    results.append(measurePhase('getPartitionedDataframeFrom...', baseUrl, lambda: functions.getPartitionedDataframeFromSalesforce(query, session, uri)))
+
+    # ingest: insert one upload of rows rescue records
+    ingestData = pd.DataFrame({
+        'Rescue_Id__c': np.arange(rows, 2 * rows), 'Food_Type__c': 'Dairy', 'Weight__c': 5, 'State__c': 'completed', 'Day_of_Pickup__c': '2021-06-01'
+    }).to_csv(index=False)
+    results.append(measurePhase('executeSalesforceIngestJob', baseUrl, lambda: functions.executeSalesforceIngestJob('insert', ingestData, 'Food_Rescue__c', session, uri)))
+    del ingestData
+
+    # accounts: upload the donors that aren't in the org yet
+    with redirect_stdout(io.StringIO()):
+        accountsDF = functions.getDataframeFromSalesforce('SELECT Id, Name, RecordTypeId FROM Account', session, uri)
+    donorsDF = functions.readAdminExport('donors')[['Name', 'location_name', 'line1', 'city', 'state', 'zip', 'county']]
+    results.append(measurePhase('uploadAccounts', baseUrl, lambda: functions.uploadAccounts(accountsDF, donorsDF, DONOR_TYPE, session, uri)))
+
+    # rescues: map and upload the whole rescues export
+    rescuesDF = functions.readAdminExport('rescues')
+    rescuesDF = rescuesDF[rescuesDF[' total_weight '].notna()]
+    results.append(measurePhase('uploadFoodRescues', baseUrl, lambda: functions.uploadFoodRescues(rescuesDF, session, uri)))
+
+    for result in results:
+        result['rows'] = rows
+    return results
+
+# helper function to run a function with an attribute of the functions module replaced, and with its output hidden
+def runWithPatchedFunction(name, replacement, function):
+    original = getattr(functions, name)
+    setattr(functions, name, replacement)
+    try:
+        with redirect_stdout(io.StringIO()):
+            return function()
+    finally:
+        setattr(functions, name, original)
+
+# function to benchmark resuming a run twice: the first run stops while its account and volunteer jobs are still processing,
+# and the second stops after its rescue job completed, but before the sent rescues were recorded
+# the exports gain a donor and then a rescue before each resumed run (they are downloaded again for every run), and the
+# resumed runs must not insert the accounts or rescues of the stopped runs again; returns the results of the last run
+def runResumeBenchmark(rows, baseUrl):
+    uri = baseUrl + '/services/data/v52.0/jobs/'
+    session = functions.createBulkSession('benchmark-session')
+    donorNames, donorParents, partnerNames, firstNames, lastNames = writeSyntheticExports(rows)
+    seedMockOrg(baseUrl, rows // 2, donorNames, partnerNames, firstNames, lastNames)
+    for path in (functions.SNAPSHOT_DB_PATH, functions.RUN_JOURNAL_PATH):
+        if os.path.exists(path):
+            os.remove(path)
+    functions.clearQueryCache()
+    functions.clearNormalizedNamesCache()
+
+    def upload():
+        accountsDF = functions.getDataframeFromSnapshot('Account', session, uri, ['Id', 'Name', 'RecordTypeId'])
+        contactsDF = functions.getDataframeFromSnapshot('Contact', session, uri, ['Id', 'Name', 'Volunteer_Id__c'])
+        return functions.uploadDataToSalesforce(accountsDF, contactsDF, session, uri)
+
+    def stopRun(*args, **kwargs):
+        raise RuntimeError('run stopped')
+
+    # first run: stops while waiting on its ingest jobs, which keep processing
+    waitForSalesforceJobs = functions.waitForSalesforceJobs
+    stopWhileIngesting = lambda jobIds, jobType, *args, **kwargs: stopRun() if jobType == 'ingest' else waitForSalesforceJobs(jobIds, jobType, *args, **kwargs)
+    runWithPatchedFunction('waitForSalesforceJobs', stopWhileIngesting, upload)
+
+    # a new export with one more donor
+    donorsDF = pd.read_csv('lastmile_donors.csv')
+    newDonorDF = donorsDF.iloc[[0]].assign(Name='Donor Chain New', location_name='Donor Location New')
+    pd.concat([donorsDF, newDonorDF], ignore_index=True).to_csv('lastmile_donors.csv', index=False)
+
+    # second run: stops as soon as the rescue insert job has completed
+    runWithPatchedFunction('recordSentFoodRescues', stopRun, upload)
+
+    # a new export with one more completed rescue
+    rescuesDF = pd.read_csv('lastmile_rescues.csv', index_col=0)
+    newRescueDF = rescuesDF.iloc[[0]].assign(rescue_id=rows, rescue_state='Complete')
+    newRescueDF[' total_weight '] = 10
+    pd.concat([rescuesDF, newRescueDF], ignore_index=True).to_csv('lastmile_rescues.csv')
+
+    result = measurePhase('resumeAfterFailure', baseUrl, upload)
+    result['rows'] = rows
+
+    with redirect_stdout(io.StringIO()):
+        keysDF = functions.getDataframeFromSalesforce('SELECT Rescue_Id__c, Food_Type__c FROM Food_Rescue__c', session, uri)
+        accountNames = functions.getDataframeFromSalesforce('SELECT Name FROM Account', session, uri)['Name']
+    result['duplicateRescues'] = int(keysDF.duplicated().sum())
+    result['duplicateAccounts'] = int(accountNames.duplicated().sum())
+    if result['duplicateRescues'] > 0:
+        raise RuntimeError('The resumed runs inserted ' + str(result['duplicateRescues']) + ' rescues again')
+    if result['duplicateAccounts'] > 0:
+        raise RuntimeError('The resumed runs inserted ' + str(result['duplicateAccounts']) + ' accounts again')
+    return result
+
+# function to print benchmark results as a table
+def printResults(results):
+    # RSS growth: peak RSS during the phase minus RSS when it started; Python heap: peak tracemalloc size
+    print('{:>9}  {:<28} {:>10} {:>14} {:>12} {:>9}'.format('rows', 'phase', 'wall (s)', 'RSS growth (MB)', 'heap (MB)', 'requests'))
+    for result in results:
+        rssGrowth = '{:.1f}'.format(result['rssGrowthMB']) if result['rssGrowthMB'] is not None else '-'
+        print('{:>9}  {:<28} {:>10.3f} {:>14} {:>12.1f} {:>9}'.format(result['rows'], result['phase'], result['wallSeconds'], rssGrowth, result['peakPythonHeapMB'], result['requests']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Salesforce pipeline against a local mock Bulk 2.0 API.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='numbers of rescue rows to benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the mock server adds to every request')
+    parser.add_argument('--processing-time', type=float, default=0.2, help='seconds each mock job takes to complete')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    process, baseUrl = startMockServerProcess(args.latency, args.processing_time)
+    results = []
+    try:
+        # run in a scratch directory: the wrappers read exports and write the snapshot store in the working directory
+        with tempfile.TemporaryDirectory() as workDir:
+            cwd = os.getcwd()
+            os.chdir(workDir)
+            try:
+                for rows in args.sizes:
+                    results += runBenchmark(rows, baseUrl)
+                    results.append(runResumeBenchmark(rows, baseUrl))
+            finally:
+                os.chdir(cwd)
+    finally:
+        process.kill()
+
+    printResults(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,35 +1,741 @@
-from zeep import Client
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 import pandas as pd
 import numpy as np
 import datetime
+import gzip
+import difflib
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+import sqlite3
+import threading
 import json
+import os
 import math
+import random
+import re
 import time
 import sys
 
+# SOAP endpoint and request body for the login call of the Enterprise API (see basic_wsdl.xml)
+# posting this envelope directly avoids parsing the full WSDL just to call login
+LOGIN_URL = 'https://login.salesforce.com/services/Soap/c/52.0'
+LOGIN_ENVELOPE = '''<?xml version="1.0" encoding="utf-8"?>
+<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/" xmlns:urn="urn:enterprise.soap.sforce.com">
+  <env:Body>
+    <urn:login>
+      <urn:username>{username}</urn:username>
+      <urn:password>{password}</urn:password>
+    </urn:login>
+  </env:Body>
+</env:Envelope>'''
+SOAP_NAMESPACES = {'env': 'http://schemas.xmlsoap.org/soap/envelope/', 'urn': 'urn:enterprise.soap.sforce.com'}
+
+# file where login sessions are cached between runs, and how long before expiry a cached session stops being reused (seconds)
+SESSION_CACHE_PATH = '.salesforce_session.json'
+SESSION_EXPIRY_MARGIN = 5 * 60
+
+# API client retries: failed requests are retried up to CLIENT_MAX_RETRIES times, waiting a random time of up to
+# CLIENT_RETRY_BASE_DELAY * 2^attempt seconds (capped at CLIENT_RETRY_MAX_DELAY) unless Salesforce sends a Retry-After header
+CLIENT_MAX_RETRIES = 5
+CLIENT_RETRY_BASE_DELAY = 1
+CLIENT_RETRY_MAX_DELAY = 60
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# POSTs create jobs, so they are only retried on responses that say Salesforce turned them away before doing anything
+RETRYABLE_POST_STATUS_CODES = (429, 503)
+# seconds to wait for a connection, and for each read of a response, before a request fails (requests without a timeout of their own)
+CLIENT_CONNECT_TIMEOUT = 10
+CLIENT_READ_TIMEOUT = 300
+
+# API client throttle: a token bucket of CLIENT_BURST requests, refilled at CLIENT_MAX_REQUESTS_PER_SECOND
+# once the org has used CLIENT_THROTTLE_USAGE of its daily API requests (Sforce-Limit-Info header),
+# the refill rate is scaled down with the requests left, to no less than CLIENT_MIN_REQUESTS_PER_SECOND
+CLIENT_MAX_REQUESTS_PER_SECOND = 25
+CLIENT_MIN_REQUESTS_PER_SECOND = 0.2
+CLIENT_BURST = 25
+CLIENT_THROTTLE_USAGE = 0.8
+
+# maximum number of rows downloaded per page of Bulk 2.0 query results
+QUERY_PAGE_SIZE = 50000
+
+# partitioned extraction: number of query jobs a query is split into, and how many are created or downloaded at the same time
+QUERY_PARTITIONS = 8
+QUERY_PARTITION_MAX_WORKERS = 4
+# datetime fields that queries can be partitioned by (any other partition field is treated as a date field)
+DATETIME_PARTITION_FIELDS = ('CreatedDate', 'LastModifiedDate', 'SystemModstamp')
+
+# Bulk 2.0 caps each upload at 100 MB, so uploads are split into pieces below that size
+INGEST_CHUNK_MAX_BYTES = 95 * 1000 * 1000
+# maximum number of rows sent to a single ingest job by the chunked upload
+INGEST_CHUNK_MAX_ROWS = 50000
+# number of ingest jobs the chunked upload runs at the same time
+INGEST_MAX_WORKERS = 4
+
+# upload bodies are gzip-compressed at this level, writing Dataframes to CSV this many rows at a time
+GZIP_COMPRESSION_LEVEL = 6
+CSV_WRITE_BLOCK_ROWS = 10000
+# size of the pieces CSV text is compressed in, and downloaded results are written to a file in
+TRANSFER_CHUNK_BYTES = 1024 * 1024
+
+# failed records with these error codes are resubmitted, in batches of at most INGEST_RETRY_BATCH_SIZE rows (halved on every attempt)
+# all other errors (validation errors, duplicates, ...) are permanent and only reported
+RETRYABLE_INGEST_ERRORS = ('UNABLE_TO_LOCK_ROW', 'REQUEST_RUNNING_TOO_LONG', 'SERVER_UNAVAILABLE', 'TXN_SECURITY_METERING_ERROR')
+INGEST_MAX_RETRIES = 3
+INGEST_RETRY_BATCH_SIZE = 2000
+# seconds to wait before a retry, multiplied by the attempt number
+INGEST_RETRY_DELAY = 5
+
+# terminal states of Bulk 2.0 query and ingest jobs
+TERMINAL_JOB_STATES = ('JobComplete', 'Failed', 'Aborted')
+# job polling starts at the initial interval (seconds) and backs off up to the max interval
+JOB_POLL_INITIAL_INTERVAL = 0.25
+JOB_POLL_MAX_INTERVAL = 10
+# maximum number of seconds to wait for jobs to finish
+JOB_WAIT_TIMEOUT = 2 * 60 * 60
+
+# local SQLite file holding snapshots of Salesforce objects, and the fields kept for each object
+SNAPSHOT_DB_PATH = 'salesforce_snapshot.db'
+SNAPSHOT_FIELDS = {
+    'Account': ['Id', 'Name', 'RecordTypeId'],
+    'Contact': ['Id', 'Name', 'Volunteer_Id__c', 'AccountId'],
+    'Food_Rescue__c': ['Id', 'Rescue_Id__c', 'Food_Type__c', 'Weight__c', 'State__c', 'Day_of_Pickup__c', 'Rescue_Detail_URL__c', 'Comments__c']
+}
+# objects whose full snapshot downloads are split into this many Id-range partitions
+# (the Id ranges are found by first downloading every Id of the object, see getIdPartitionConditions)
+SNAPSHOT_PARTITIONS = {'Food_Rescue__c': QUERY_PARTITIONS}
+
+# compact column types of Salesforce extracts (query results and snapshot reads)
+# 'id': record IDs, stored as pd.StringDtype('pyarrow') strings (pyarrow is in requirements.txt; see getIdStringType)
+# 'category': picklists and lookups that point at a handful of records; 'Int64': whole numbers that can be missing
+SALESFORCE_FIELD_TYPES = {
+    'Id': 'id', 'ParentId': 'id',
+    'RecordTypeId': 'category', 'AccountId': 'category', 'State__c': 'category', 'Food_Type__c': 'category', 'County__c': 'category',
+    'Weight__c': 'Int64', 'Volunteer_Id__c': 'Int64'
+}
+
+# the per-run query cache evicts the least recently used results once it holds more rows or entries than this
+QUERY_CACHE_MAX_ROWS = 2000000
+QUERY_CACHE_MAX_ENTRIES = 32
+
+# duplicate detection: names whose keys are at least this similar (0 to 1) are grouped as candidate duplicates,
+# comparing each key with the next DUPLICATE_WINDOW_SIZE - 1 keys in sorted order
+DUPLICATE_SIMILARITY_THRESHOLD = 0.9
+DUPLICATE_WINDOW_SIZE = 5
+
+# declared schemas of the admin tool CSV exports
+# usecols: columns to read (a list, or a function that decides per column name)
+# dtype: explicit column types; naValues: sentinel values read as NA, per column
+RESCUE_EXPORT_UNUSED_COLUMNS = ['Unnamed: 0', 'donor_name', 'recipient_name', 'estimated_quantity', 'reported_quantity', ' unit_weight ', 'volunteer_id']
+ADMIN_EXPORTS = {
+    'donors': {
+        'path': 'lastmile_donors.csv',
+        'usecols': ['Name', 'location_name', 'line1', 'city', 'state', 'zip', 'county'],
+        'dtype': {'Name': 'object', 'location_name': 'object', 'line1': 'object', 'city': 'object', 'state': 'object', 'zip': 'string', 'county': 'object'},
+        'naValues': {}
+    },
+    'partners': {
+        'path': 'lastmile_partners.csv',
+        'usecols': ['Name', 'location_name', 'line1', 'city', 'state', 'zip'],
+        'dtype': {'Name': 'object', 'location_name': 'object', 'line1': 'object', 'city': 'object', 'state': 'object', 'zip': 'string'},
+        'naValues': {}
+    },
+    'volunteers': {
+        'path': 'lastmile_volunteers.csv',
+        'usecols': ['user_id', 'first_name', 'last_name', 'email', 'phone', 'address', 'city', 'state', 'zip', 'county', 'user_state'],
+        'dtype': {'user_id': 'Int64', 'phone': 'Int64', 'zip': 'string', 'user_state': 'category'},
+        'naValues': {}
+    },
+    'rescues': {
+        'path': 'lastmile_rescues.csv',
+        'usecols': lambda col: col not in RESCUE_EXPORT_UNUSED_COLUMNS,
+        'dtype': {'food_type': 'object', 'rescue_state': 'category', ' total_weight ': 'Int64'},
+        'naValues': {' total_weight ': ['Please assign weight']}
+    }
+}
+
+# number of upload stages run at the same time, and the size of the HTTP connection pool they share
+# (every stage can run INGEST_MAX_WORKERS ingest jobs at once, so the pool is sized for all of them)
+STAGE_MAX_WORKERS = 3
+CONNECTION_POOL_SIZE = STAGE_MAX_WORKERS * INGEST_MAX_WORKERS + 2
+
+# default output file of the rescue reconciliation report
+RECONCILIATION_REPORT_PATH = 'rescue_reconciliation.json'
+
+# file where an upload run records its progress (completed stages and submitted jobs) until it has finished
+RUN_JOURNAL_PATH = 'sync_run_journal.json'
+
+# default output files of the run report and the Prometheus textfile
+RUN_REPORT_PATH = 'run_report.json'
+PROMETHEUS_TEXTFILE_PATH = 'salesforce_sync.prom'
+
+# request headers for JSON and CSV bodies
+# passed per request instead of set on the session, so one session can be shared across threads
+JSON_HEADERS = {'Content-Type': 'application/json;charset=utf-8'}
+CSV_HEADERS = {'Content-Type': 'text/csv;charset=UTF-8'}
+# uploads are sent gzip-compressed, and results are requested gzip-compressed
+CSV_GZIP_HEADERS = {'Content-Type': 'text/csv;charset=UTF-8', 'Content-Encoding': 'gzip'}
+ACCEPT_GZIP_HEADERS = {'Accept-Encoding': 'gzip'}
+
+### RUN METRICS
+
+# timed spans and counters recorded during a run
+_runMetrics = {'startedAt': time.time(), 'spans': [], 'counters': Counter(), 'stages': {}}
+_runMetricsLock = threading.Lock()
+
+# context manager that records how long a step of the run took, e.g. with timedSpan('query.poll', jobId=jobId): ...
+# tags are stored with the span; spans that raise (or exit) are recorded with status 'error'
+@contextmanager
+def timedSpan(name, **tags):
+    startedAt = time.time()
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        span = {'name': name, 'tags': tags, 'startedAt': startedAt, 'seconds': time.perf_counter() - start, 'status': status, 'thread': threading.current_thread().name}
+        with _runMetricsLock:
+            _runMetrics['spans'].append(span)
+
+# function to add to a run counter (poll requests, records processed, ...)
+def incrementCounter(name, amount=1):
+    with _runMetricsLock:
+        _runMetrics['counters'][name] += amount
+
+# function to clear all spans and counters and start a new run
+def resetRunMetrics():
+    with _runMetricsLock:
+        _runMetrics['startedAt'] = time.time()
+        _runMetrics['spans'] = []
+        _runMetrics['counters'] = Counter()
+        _runMetrics['stages'] = {}
+
+# function to record the outcome of an upload stage (ok, failed or skipped) in the run report
+def recordStageOutcome(name, outcome):
+    with _runMetricsLock:
+        _runMetrics['stages'][name] = outcome
+
+# function to build the machine-readable run report: stage outcomes, every span, the counters, and per-span-name totals
+def getRunReport():
+    with _runMetricsLock:
+        spans = list(_runMetrics['spans'])
+        counters = dict(_runMetrics['counters'])
+        startedAt = _runMetrics['startedAt']
+        stages = dict(_runMetrics['stages'])
+
+    summary = {}
+    for span in spans:
+        entry = summary.setdefault(span['name'], {'count': 0, 'totalSeconds': 0.0, 'maxSeconds': 0.0, 'errors': 0})
+        entry['count'] += 1
+        entry['totalSeconds'] += span['seconds']
+        entry['maxSeconds'] = max(entry['maxSeconds'], span['seconds'])
+        entry['errors'] += span['status'] == 'error'
+
+    return {'startedAt': startedAt, 'finishedAt': time.time(), 'stages': stages, 'summary': summary, 'counters': counters, 'spans': spans}
+
+# function to write the run report to a JSON file
+def writeRunReport(path=RUN_REPORT_PATH):
+    with open(path, 'w') as f:
+        json.dump(getRunReport(), f, indent=2, default=str)
+    print('Run report written to ' + path)
+
+# prometheus-client collector that exposes the current run metrics
+# (built lazily so prometheus-client is only imported when metrics are exported)
+def buildPrometheusCollector():
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+    class RunMetricsCollector:
+        def collect(self):
+            report = getRunReport()
+            seconds = GaugeMetricFamily('salesforce_sync_span_seconds', 'Total seconds spent in each step of the sync run', labels=['span'])
+            counts = GaugeMetricFamily('salesforce_sync_span_count', 'Number of times each step of the sync run ran', labels=['span'])
+            errors = GaugeMetricFamily('salesforce_sync_span_errors', 'Number of times each step of the sync run failed', labels=['span'])
+            for name, entry in report['summary'].items():
+                seconds.add_metric([name], entry['totalSeconds'])
+                counts.add_metric([name], entry['count'])
+                errors.add_metric([name], entry['errors'])
+            yield seconds
+            yield counts
+            yield errors
+
+            counters = CounterMetricFamily('salesforce_sync_events', 'Counters recorded during the sync run', labels=['counter'])
+            for name, value in report['counters'].items():
+                counters.add_metric([name], value)
+            yield counters
+
+            yield GaugeMetricFamily('salesforce_sync_run_started_timestamp_seconds', 'Start time of the sync run', value=report['startedAt'])
+
+    return RunMetricsCollector()
+
+# function to write the run metrics as a Prometheus textfile (for the node_exporter textfile collector)
+def writePrometheusTextfile(path=PROMETHEUS_TEXTFILE_PATH):
+    from prometheus_client import CollectorRegistry, write_to_textfile
+
+    registry = CollectorRegistry()
+    registry.register(buildPrometheusCollector())
+    write_to_textfile(path, registry)
+    print('Prometheus metrics written to ' + path)
+
+# function to serve the live run metrics on http://localhost:<port>/metrics for Prometheus to scrape
+def startPrometheusExporter(port):
+    from prometheus_client import CollectorRegistry, start_http_server
+
+    registry = CollectorRegistry()
+    registry.register(buildPrometheusCollector())
+    start_http_server(port, registry=registry)
+
+### RUN JOURNAL
+
+# journal of the current upload run, saved to a JSON file after every change so that a run that stops partway can be resumed
+# stages: name => {'inputsHash', 'finishedAt'} of every completed stage
+# jobs: upload payload hash => {'jobId', 'object', 'operation', 'state'} of every ingest job submitted in this run
+# resumableJobs: the jobs of the earlier run being resumed, each of which can be re-attached to once
+_runJournal = {'path': None, 'startedAt': None, 'stages': {}, 'jobs': {}, 'resumableJobs': {}}
+_runJournalLock = threading.Lock()
+
+# helper function to hash the contents of a file (None if the file doesn't exist)
+def hashFile(path):
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(TRANSFER_CHUNK_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# function to hash the admin tool exports a stage reads (see ADMIN_EXPORTS)
+# a completed stage is only skipped on resume if this hash hasn't changed
+def hashAdminExports(names):
+    digest = hashlib.sha256()
+    for name in names:
+        digest.update((name + '=' + str(hashFile(ADMIN_EXPORTS[name]['path'])) + ';').encode('utf-8'))
+    return digest.hexdigest()
+
+# helper function to hash an upload body together with the kind of job it is sent to
+# upload bodies are compressed with a fixed gzip timestamp, so the same data always gives the same hash
+def hashUploadPayload(operation, objectType, externalIdFieldName, body):
+    digest = hashlib.sha256((operation + ';' + objectType + ';' + str(externalIdFieldName) + ';').encode('utf-8'))
+    body.seek(0)
+    for block in iter(lambda: body.read(TRANSFER_CHUNK_BYTES), b''):
+        digest.update(block)
+    body.seek(0)
+    return digest.hexdigest()
+
+# helper function to write the journal to its file (called with _runJournalLock held)
+# the file is replaced in one step, so a run killed while saving leaves the last complete journal behind
+def saveRunJournal():
+    if _runJournal['path'] is None:
+        return
+    journal = {
+        'startedAt': _runJournal['startedAt'],
+        'updatedAt': time.time(),
+        'stages': _runJournal['stages'],
+        'jobs': {**_runJournal['resumableJobs'], **_runJournal['jobs']}
+    }
+    tempPath = _runJournal['path'] + '.tmp'
+    with open(tempPath, 'w') as f:
+        json.dump(journal, f, indent=2)
+    os.replace(tempPath, _runJournal['path'])
+
+# function to start journaling an upload run to path
+# with resume=True the journal an unfinished earlier run left at path is loaded: its completed stages can be skipped
+# and its ingest jobs re-attached to; with resume=False any earlier journal is discarded
+def startRunJournal(path=RUN_JOURNAL_PATH, resume=True):
+    journal = {}
+    if resume and os.path.exists(path):
+        with open(path) as f:
+            journal = json.load(f)
+        print('Resuming the run started ' + time.ctime(journal['startedAt']) + ': ' + str(len(journal['stages'])) + ' stages completed, ' + str(len(journal['jobs'])) + ' jobs submitted.\n')
+
+    with _runJournalLock:
+        _runJournal['path'] = path
+        _runJournal['startedAt'] = journal.get('startedAt', time.time())
+        _runJournal['stages'] = journal.get('stages', {})
+        _runJournal['jobs'] = {}
+        _runJournal['resumableJobs'] = journal.get('jobs', {})
+        saveRunJournal()
+
+# function to stop journaling the current run
+# the journal file is deleted once the run has finished (delete=True), and kept otherwise so the next run can resume from it
+def stopRunJournal(delete=False):
+    with _runJournalLock:
+        path = _runJournal['path']
+        _runJournal.update(path=None, startedAt=None, stages={}, jobs={}, resumableJobs={})
+
+    if path is None:
+        return
+    if delete:
+        if os.path.exists(path):
+            os.remove(path)
+    else:
+        print('Run journal kept at ' + path + ': run again to continue from the first unfinished stage.')
+
+# function to list the completed jobs of the run being resumed that inserted or updated records of objectType
+def getResumableIngestJobIds(objectType):
+    with _runJournalLock:
+        jobs = list(_runJournal['resumableJobs'].values())
+    return [job['jobId'] for job in jobs if job['object'] == objectType and job['operation'] in ('insert', 'update', 'upsert') and job['state'] == 'JobComplete']
+
+# function to read the records of objectType again if jobs of the run being resumed inserted or updated them
+# df was read before the run started, so it misses the records of jobs that were still processing when the earlier run
+# stopped; once those jobs are settled (see settleJournaledIngestJobs), the same columns are read from the snapshot
+def refreshJournaledRecords(df, objectType, session, uri):
+    if not getResumableIngestJobIds(objectType):
+        return df
+    print('Reading ' + objectType + ' records again, the earlier run sent jobs for them.')
+    invalidateQueryCache(objectType)
+    return getDataframeFromSnapshot(objectType, session, uri, list(df.columns) if len(df.columns) > 0 else None)
+
+# function to check whether a stage completed in the run being resumed, with the same inputs
+def isStageJournaled(name, inputsHash):
+    with _runJournalLock:
+        stage = _runJournal['stages'].get(name)
+    return stage is not None and stage['inputsHash'] == inputsHash
+
+# function to record that a stage has completed
+def recordJournaledStage(name, inputsHash):
+    with _runJournalLock:
+        if _runJournal['path'] is None:
+            return
+        _runJournal['stages'][name] = {'inputsHash': inputsHash, 'finishedAt': time.time()}
+        saveRunJournal()
+
+# function to wrap a stage function so that the stage is recorded in the journal once it has completed
+def journaledStage(name, inputsHash, function):
+    def run():
+        function()
+        recordJournaledStage(name, inputsHash)
+    return run
+
+# function to find a job of the run being resumed that was sent the same upload, to re-attach to instead of submitting it again
+# returns the job ID, or None if there is no such job
+def findJournaledIngestJob(payloadHash):
+    with _runJournalLock:
+        job = _runJournal['resumableJobs'].pop(payloadHash, None)
+        if job is None:
+            return None
+        _runJournal['jobs'][payloadHash] = job
+    return job['jobId']
+
+# function to record the state of the ingest job an upload was sent to
+def recordJournaledIngestJob(payloadHash, jobId, objectType, operation, state):
+    with _runJournalLock:
+        if _runJournal['path'] is None:
+            return
+        _runJournal['jobs'][payloadHash] = {'jobId': jobId, 'object': objectType, 'operation': operation, 'state': state}
+        saveRunJournal()
+
+# function to update the journaled states of ingest jobs from their job info (job ID => job info, see waitForSalesforceJobs)
+def recordJournaledJobStates(jobInfo):
+    with _runJournalLock:
+        if _runJournal['path'] is None:
+            return
+        for job in list(_runJournal['jobs'].values()) + list(_runJournal['resumableJobs'].values()):
+            if job['jobId'] in jobInfo:
+                job['state'] = jobInfo[job['jobId']]['state']
+        saveRunJournal()
+
+# function to settle the unfinished ingest jobs of the run being resumed before any stage starts
+# jobs whose upload never finished are still Open and can't run, so they are aborted; jobs still processing are waited on,
+# so the stages see the records they created; jobs that failed, were aborted or no longer exist are submitted again
+def settleJournaledIngestJobs(session, uri):
+    with _runJournalLock:
+        jobIds = [job['jobId'] for job in _runJournal['resumableJobs'].values() if job['state'] not in TERMINAL_JOB_STATES]
+
+    jobInfo = {}
+    for jobId in jobIds:
+        response = session.get(uri+'ingest/'+jobId)
+        jobInfo[jobId] = response.json() if response.status_code == 200 else {'state': 'Aborted'}
+        if jobInfo[jobId]['state'] == 'Open':
+            response = session.patch(uri+'ingest/'+jobId, data=json.dumps({'state': 'Aborted'}), headers=JSON_HEADERS)
+            jobInfo[jobId] = {'state': 'Aborted'}
+            print('Aborted job ' + jobId + ' from the earlier run, its upload never finished.')
+
+    runningJobIds = [jobId for jobId, info in jobInfo.items() if info['state'] not in TERMINAL_JOB_STATES]
+    if runningJobIds:
+        print('Waiting for ' + str(len(runningJobIds)) + ' jobs from the earlier run to complete...')
+        with timedSpan('journal.settle', jobIds=runningJobIds):
+            jobInfo.update(waitForSalesforceJobs(runningJobIds, 'ingest', session, uri))
+    recordJournaledJobStates(jobInfo)
+
+    with _runJournalLock:
+        resumableJobs = _runJournal['resumableJobs']
+        _runJournal['resumableJobs'] = {payloadHash: job for payloadHash, job in resumableJobs.items() if job['state'] not in ('Failed', 'Aborted')}
+        saveRunJournal()
+
+### SALESFORCE API CLIENT
+
+# HTTP client for all Salesforce API calls, used in place of a plain requests session (same get/post/put/patch methods)
+# - one sized keep-alive connection pool, shared safely by all threads (headers are passed per request)
+# - times out stalled requests, and retries connection errors and timeouts, 5xx and 429 responses and REQUEST_LIMIT_EXCEEDED
+#   errors with jittered exponential backoff (job-creating POSTs are only retried if they never reached Salesforce,
+#   or were rejected with 429, 503 or REQUEST_LIMIT_EXCEEDED)
+# - throttles requests with a token bucket that slows down as the org's daily API usage (Sforce-Limit-Info) runs out
+# - logs in again when the session expires (401 INVALID_SESSION_ID), if it was given a login function
+class SalesforceClient(requests.Session):
+    # login: function with no arguments that returns a new session ID (see loginToSalesforce)
+    def __init__(self, sessionId, login=None, poolSize=CONNECTION_POOL_SIZE, maxRetries=CLIENT_MAX_RETRIES):
+        super().__init__()
+        mountConnectionPool(self, poolSize)
+        self.sessionId = sessionId
+        self.login = login
+        self.maxRetries = maxRetries
+        self.authLock = threading.Lock()
+        # set while a thread is logging in again, other threads with an expired session wait for it
+        self.loginDone = None
+
+        # token bucket state
+        self.throttleLock = threading.Lock()
+        self.requestsPerSecond = CLIENT_MAX_REQUESTS_PER_SECOND
+        self.tokens = CLIENT_BURST
+        self.lastRefill = time.monotonic()
+        self.apiUsage = None
+
+    # sends a request with retries, throttling and reauthentication; takes the same arguments as requests.Session.request
+    def request(self, method, url, **kwargs):
+        attempt = 0
+        reauthenticated = False
+        # without a timeout, a stalled connection would block the run forever
+        kwargs.setdefault('timeout', (CLIENT_CONNECT_TIMEOUT, CLIENT_READ_TIMEOUT))
+        while True:
+            self.waitForToken()
+
+            # the session ID is sent per request, so a new one after reauthentication is picked up by every thread
+            sessionId = self.sessionId
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, Authorization='Bearer ' + sessionId)
+
+            # upload bodies are file objects, so they are rewound before every attempt
+            data = kwargs.get('data')
+            if hasattr(data, 'seek'):
+                data.seek(0)
+
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # POSTs create jobs, so they are only sent again if they never reached Salesforce (an orphaned job is left otherwise)
+                if attempt >= self.maxRetries or (method.upper() == 'POST' and not self.wasNeverSent(e)):
+                    raise
+                attempt += 1
+                self.waitBeforeRetry(attempt, None, type(e).__name__)
+                continue
+
+            self.updateApiUsage(response)
+
+            if response.status_code == 401 and 'INVALID_SESSION_ID' in response.text and self.login is not None and not reauthenticated:
+                self.reauthenticate(sessionId)
+                reauthenticated = True
+                continue
+
+            if self.isRetryable(response, method) and attempt < self.maxRetries:
+                attempt += 1
+                self.waitBeforeRetry(attempt, response, 'status ' + str(response.status_code))
+                response.close()
+                continue
+
+            return response
+
+    # checks whether a failed request never reached Salesforce, because no connection could be made
+    # (a connection that fails after it was made may have delivered the request)
+    def wasNeverSent(self, error):
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    # checks whether a response is a temporary failure worth retrying
+    # a POST that failed with 500, 502 or 504 may still have created its job, so it is not sent again
+    def isRetryable(self, response, method='GET'):
+        retryableStatusCodes = RETRYABLE_POST_STATUS_CODES if method.upper() == 'POST' else RETRYABLE_STATUS_CODES
+        if response.status_code in retryableStatusCodes:
+            return True
+        return response.status_code == 403 and 'REQUEST_LIMIT_EXCEEDED' in response.text
+
+    # sleeps before a retry: the Retry-After header if Salesforce sent one, otherwise a jittered exponential backoff
+    def waitBeforeRetry(self, attempt, response, reason):
+        retryAfter = response.headers.get('Retry-After') if response is not None else None
+        if retryAfter is not None and retryAfter.isdigit():
+            delay = int(retryAfter)
+        else:
+            delay = random.uniform(0, min(CLIENT_RETRY_MAX_DELAY, CLIENT_RETRY_BASE_DELAY * 2 ** attempt))
+        incrementCounter('http_retries')
+        print('Request failed (' + reason + '), retrying in ' + str(round(delay, 1)) + ' seconds (attempt ' + str(attempt) + ' of ' + str(self.maxRetries) + ')...')
+        time.sleep(delay)
+
+    # logs in again after Salesforce rejected expiredSessionId; only the first thread to notice does the login
+    # (the lock is not held during the login call, other threads wait for it to finish for at most one request timeout)
+    def reauthenticate(self, expiredSessionId):
+        with self.authLock:
+            if self.sessionId != expiredSessionId:
+                return
+            loginDone = self.loginDone
+            if loginDone is None:
+                self.loginDone = threading.Event()
+        if loginDone is not None:
+            loginDone.wait(CLIENT_CONNECT_TIMEOUT + CLIENT_READ_TIMEOUT)
+            return
+
+        try:
+            print('Salesforce session expired, logging in again...')
+            incrementCounter('reauthentications')
+            sessionId = self.login()
+            with self.authLock:
+                self.sessionId = sessionId
+        finally:
+            with self.authLock:
+                loginDone, self.loginDone = self.loginDone, None
+            loginDone.set()
+
+    # takes a token from the bucket, sleeping until one is available
+    def waitForToken(self):
+        with self.throttleLock:
+            now = time.monotonic()
+            self.tokens = min(CLIENT_BURST, self.tokens + (now - self.lastRefill) * self.requestsPerSecond)
+            self.lastRefill = now
+            # tokens can go negative: each waiting thread reserves its token and sleeps until the bucket refills past it
+            self.tokens -= 1
+            delay = -self.tokens / self.requestsPerSecond if self.tokens < 0 else 0
+        if delay > 0:
+            incrementCounter('throttle_waits')
+            time.sleep(delay)
+
+    # reads the org's daily API usage from the Sforce-Limit-Info header (api-usage=used/limit) and sets the request rate
+    def updateApiUsage(self, response):
+        match = re.search(r'api-usage=(\d+)/(\d+)', response.headers.get('Sforce-Limit-Info', ''))
+        if match is None or int(match.group(2)) == 0:
+            return
+
+        used, limit = int(match.group(1)), int(match.group(2))
+        usage = used / limit
+        if usage > CLIENT_THROTTLE_USAGE:
+            rate = CLIENT_MAX_REQUESTS_PER_SECOND * (1 - usage) / (1 - CLIENT_THROTTLE_USAGE)
+            rate = max(CLIENT_MIN_REQUESTS_PER_SECOND, rate)
+        else:
+            rate = CLIENT_MAX_REQUESTS_PER_SECOND
+
+        with self.throttleLock:
+            if rate < CLIENT_MAX_REQUESTS_PER_SECOND <= self.requestsPerSecond:
+                print('Salesforce API usage at ' + str(used) + ' of ' + str(limit) + ' daily requests, slowing down requests.')
+            self.apiUsage = (used, limit)
+            self.requestsPerSecond = rate
+
 ### AUTH FUNCTIONS
 
-# login function that returns a Salesforce API session
-def loginToSalesforce(username, password, securityToken):
-    wsdl = './basic_wsdl.xml'
-    
-    SOAPclient = Client(wsdl)
-    data = {'username': username, 'password': password+securityToken}
-    response = SOAPclient.service.login(**data)
-    sessionId = response.sessionId
-
-    # create session for Bulk 2.0 API calls
-    session = requests.Session()
-    session.headers.update({'Authorization': 'Bearer '+ sessionId})
-    
+# helper function to create an API client for Bulk 2.0 API calls from a session ID (see SalesforceClient)
+# login is an optional function that returns a new session ID once this one expires
+def createBulkSession(sessionId, login=None):
+    return SalesforceClient(sessionId, login)
+
+# helper function to give a session a connection pool of poolSize connections per host
+# (requests keeps only 10 by default, so busier runs would keep opening and discarding connections)
+def mountConnectionPool(session, poolSize=CONNECTION_POOL_SIZE):
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
     return session
 
-# login function for Salesforce sandbox, returns a dev session for testing
+# helper function to load a cached session ID for a user, returns None if there is none or it is about to expire
+def loadCachedSessionId(username, path=SESSION_CACHE_PATH):
+    try:
+        with open(path) as f:
+            entry = json.load(f).get(username)
+    except (OSError, ValueError):
+        return None
+
+    if entry is None or entry['expiresAt'] - SESSION_EXPIRY_MARGIN < time.time():
+        return None
+    return entry['sessionId']
+
+# helper function to cache a session ID for a user until it expires
+# the cache file is only readable by the current user
+def saveCachedSessionId(username, sessionId, secondsValid, path=SESSION_CACHE_PATH):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    cache[username] = {'sessionId': sessionId, 'expiresAt': time.time() + secondsValid}
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+
+# function to remove a user's session from the cache (e.g. after Salesforce rejects it)
+def clearCachedSessionId(username, path=SESSION_CACHE_PATH):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    if cache.pop(username, None) is not None:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+
+# login function that returns a Salesforce API client (see SalesforceClient)
+# reuses a cached session until it expires; otherwise posts a minimal SOAP login envelope
+# the client logs in again by itself when its session expires during a run
+def loginToSalesforce(username, password, securityToken, useSessionCache=True):
+    # called by the client when Salesforce rejects the session: drops the cached session and logs in again
+    def login():
+        if useSessionCache:
+            clearCachedSessionId(username)
+        return requestSessionId(username, password, securityToken, useSessionCache)
+
+    if useSessionCache:
+        sessionId = loadCachedSessionId(username)
+        if sessionId is not None:
+            incrementCounter('login_cache_hits')
+            return createBulkSession(sessionId, login)
+
+    # create client for Bulk 2.0 API calls
+    return createBulkSession(requestSessionId(username, password, securityToken, useSessionCache), login)
+
+# function to log in with the SOAP login call, returns the new session ID (and caches it if useSessionCache is set)
+def requestSessionId(username, password, securityToken, useSessionCache=True):
+    body = LOGIN_ENVELOPE.format(username=escape(username), password=escape(password+securityToken))
+    headers = {'Content-Type': 'text/xml;charset=UTF-8', 'SOAPAction': 'login'}
+    with timedSpan('login'):
+        response = requests.post(LOGIN_URL, data=body.encode('utf-8'), headers=headers, timeout=(CLIENT_CONNECT_TIMEOUT, CLIENT_READ_TIMEOUT))
+
+    if response.status_code != 200:
+        # SOAP faults are XML, but errors from proxies or load balancers in front of Salesforce can be anything (e.g. HTML)
+        fault = None
+        if 'xml' in response.headers.get('Content-Type', ''):
+            try:
+                fault = ElementTree.fromstring(response.content).find('.//faultstring')
+            except ElementTree.ParseError:
+                pass
+        print('Login failed (status code ' + str(response.status_code) + '): ' + (fault.text if fault is not None else response.text))
+        sys.exit()
+
+    root = ElementTree.fromstring(response.content)
+    result = root.find('env:Body/urn:loginResponse/urn:result', SOAP_NAMESPACES)
+    sessionId = result.find('urn:sessionId', SOAP_NAMESPACES).text
+    secondsValid = int(result.find('urn:userInfo/urn:sessionSecondsValid', SOAP_NAMESPACES).text)
+
+    if useSessionCache:
+        saveCachedSessionId(username, sessionId, secondsValid)
+    return sessionId
+
+# login function for Salesforce sandbox, returns a dev API client for testing
 # DEVELOPMENT MODE -- FOR TESTING ONLY
 # need to pull client ID and client secret from a sandbox in Salesforce and plug them into this function below
 def loginToSalesforceSANDBOX(username, password, securityToken):
+    # create client for Bulk 2.0 API calls, logging in again whenever the session expires
+    login = lambda: requestSandboxSessionId(username, password, securityToken)
+    return createBulkSession(login(), login)
+
+# function to log in to a Salesforce sandbox with the OAuth password flow, returns the new session ID
+def requestSandboxSessionId(username, password, securityToken):
     # API variables for development mode
     clientId = ''
     clientSecret = ''
@@ -42,35 +748,124 @@ def loginToSalesforceSANDBOX(username, password, securityToken):
         'username': username,
         'password': password+securityToken
     }
-    response = requests.post('https://test.salesforce.com/services/oauth2/token', data=data, headers=headers)
-    sessionId = response.json()['access_token']
-
-    # create session for Bulk 2.0 API calls
-    session = requests.Session()
-    session.headers.update({'Authorization': 'Bearer '+ sessionId})
-    
-    return session
+    with timedSpan('login'):
+        response = requests.post('https://test.salesforce.com/services/oauth2/token', data=data, headers=headers, timeout=(CLIENT_CONNECT_TIMEOUT, CLIENT_READ_TIMEOUT))
+    return response.json()['access_token']
 
 ### GENERAL HELPERS
 
+# function to normalize a whole column of names at once
+# collapses runs of whitespace, and optionally folds case and strips accents/compatibility characters (unicodeFold)
+def normalizeNames(series, casefold=False, unicodeFold=False):
+    with timedSpan('pandas.normalize', column=series.name, rows=len(series)):
+        names = series.astype(str).str.replace(r'\s+', ' ', regex=True).str.strip()
+        if unicodeFold:
+            names = names.str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('ascii')
+        if casefold:
+            names = names.str.casefold()
+    return names
+
 # helper function to cleanup whitespace between words in a DF column
 def cleanupNameWhitespace(df, colName):
-    for index, row in df.iterrows():
-        df.at[index, colName] = ' '.join(str(df.at[index, colName]).split())
+    df[colName] = normalizeNames(df[colName])
+    return df
+
+# cache of normalized name columns: (id of Dataframe, column, options) => (Dataframe, normalized names)
+# keeping a reference to the Dataframe stops its id from being reused while the entry exists
+_normalizedNamesCache = {}
+
+# function that returns the normalized names of a Dataframe column, normalizing them only once per Dataframe
+# used for the Salesforce Account and Contact frames, which are shared by all wrappers during a run
+# NOTE: the cache does not notice in-place edits of the Dataframe
+def getNormalizedNames(df, colName, casefold=False, unicodeFold=False):
+    key = (id(df), colName, casefold, unicodeFold)
+    entry = _normalizedNamesCache.get(key)
+    if entry is None or entry[0] is not df:
+        entry = (df, normalizeNames(df[colName], casefold, unicodeFold))
+        _normalizedNamesCache[key] = entry
+    return entry[1]
+
+# function to build a name => Id hash index from two Dataframe columns (first Id wins for duplicate names)
+def buildNameIndex(df, nameCol, idCol):
+    df = df.drop_duplicates(subset=nameCol)
+    return dict(zip(df[nameCol], df[idCol]))
+
+# function to drop all cached normalized names (called at the start and end of each run)
+def clearNormalizedNamesCache():
+    _normalizedNamesCache.clear()
+
+### ADMIN TOOL EXPORT READERS
+
+# helper function to check whether pandas can use the (much faster) pyarrow CSV parser
+def pyarrowCSVEngineAvailable():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    version = tuple(int(part) for part in re.findall(r'\d+', pd.__version__)[:2])
+    return version >= (1, 4)
+
+# function to read an admin tool export ('donors', 'partners', 'volunteers' or 'rescues') using its declared schema
+# only the needed columns are parsed, with explicit types and sentinel values mapped to NA
+# with chunksize set, returns an iterator of Dataframes of at most chunksize rows instead of one Dataframe
+def readAdminExport(name, path=None, chunksize=None):
+    schema = ADMIN_EXPORTS[name]
+    if path is None:
+        path = schema['path']
+
+    # resolve the columns to read against the header, skipping declared columns the file doesn't have
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = schema['usecols']
+    if callable(usecols):
+        usecols = [col for col in header if usecols(col)]
+    else:
+        usecols = [col for col in usecols if col in header]
+    dtype = {col: colType for col, colType in schema['dtype'].items() if col in usecols}
+
+    # the pyarrow parser doesn't support chunked reads or per-column NA values
+    if chunksize is None and pyarrowCSVEngineAvailable():
+        naValues = [value for values in schema['naValues'].values() for value in values]
+        return pd.read_csv(path, usecols=usecols, dtype=dtype, na_values=naValues, engine='pyarrow')
+
+    return pd.read_csv(path, usecols=usecols, dtype=dtype, na_values=schema['naValues'], chunksize=chunksize)
+
+### SALESFORCE EXTRACT TYPES
+
+# helper function to get the string type used for record ID columns: pd.StringDtype('pyarrow')
+# Arrow-backed strings keep the 18-character IDs in one buffer instead of one Python object per ID
+# falls back to the plain pd.StringDtype() (one Python object per ID) if pyarrow or pandas >= 1.3 is missing
+def getIdStringType():
+    try:
+        import pyarrow
+        return pd.StringDtype('pyarrow')
+    except (ImportError, TypeError):
+        return pd.StringDtype()
+
+# function to convert the columns of a Salesforce extract to their compact types (see SALESFORCE_FIELD_TYPES)
+# columns that aren't declared are left as they are; numbers with decimals are kept as floats instead of Int64
+def applySalesforceFieldTypes(df):
+    for col in df.columns:
+        colType = SALESFORCE_FIELD_TYPES.get(col)
+        if colType == 'id':
+            df[col] = df[col].astype(getIdStringType())
+        elif colType == 'Int64':
+            numbers = pd.to_numeric(df[col])
+            df[col] = numbers.astype('Int64') if (numbers.dropna() % 1 == 0).all() else numbers
+        elif colType is not None:
+            df[col] = df[col].astype(colType)
     return df
 
 ### SALESFORCE BULK 2.0 API FUNCTIONS: QUERY AND INGEST
 
-# function to query Salesforce and return a Pandas Dataframe
-def getDataframeFromSalesforce(query, session, uri):  
-    session.headers.update({'Content-Type': 'application/json;charset=utf-8'})
-    
-    # create a job to query all Account records
+# helper function to create a Bulk 2.0 query job and return its job ID
+def createSalesforceQueryJob(query, session, uri):
+    # create a job to run the query
     data = json.dumps({
       "operation": "query",
       "query": query,
     })
-    response = session.post(uri+'query', data=data)
+    with timedSpan('query.create'):
+        response = session.post(uri+'query', data=data, headers=JSON_HEADERS)
 
     if (response.status_code == 200):
         print('Query job created.')
@@ -80,38 +875,248 @@ def getDataframeFromSalesforce(query, session, uri):
         sys.exit()
 
     # pull out job ID to use for future requests
-    jobId = response.json().get('id')
+    return response.json().get('id')
 
-    # wait for job to complete before getting results
+# function that waits on several query or ingest jobs at once (jobType is 'query' or 'ingest')
+# polls every unfinished job, then sleeps with exponential backoff; the interval is kept short while job states keep changing
+# returns a dict of job ID => last job info received; jobs still running at the deadline keep their non-terminal state
+def waitForSalesforceJobs(jobIds, jobType, session, uri, timeout=JOB_WAIT_TIMEOUT, initialInterval=JOB_POLL_INITIAL_INTERVAL, maxInterval=JOB_POLL_MAX_INTERVAL, backoffFactor=2):
+    deadline = time.monotonic() + timeout
+    interval = initialInterval
+    pending = list(jobIds)
+    jobInfo = {}
+
+    while pending:
+        stateChanged = False
+        stillPending = []
+        for jobId in pending:
+            response = session.get(uri+jobType+'/'+jobId)
+            incrementCounter(jobType + '_poll_requests')
+            if response.status_code == 200:
+                jsonRes = response.json()
+            else:
+                # a job that can't be polled (unknown or purged job, server errors after all retries) is treated as failed
+                jsonRes = {'id': jobId, 'state': 'Failed', 'errorMessage': 'Polling the job failed (status code ' + str(response.status_code) + '): ' + response.text}
+            if jobId not in jobInfo or jobInfo[jobId]['state'] != jsonRes['state']:
+                stateChanged = True
+            jobInfo[jobId] = jsonRes
+            if jsonRes['state'] not in TERMINAL_JOB_STATES:
+                stillPending.append(jobId)
+        pending = stillPending
+
+        if not pending:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print('Timed out waiting for jobs: ' + ', '.join(pending))
+            break
+
+        # back off while nothing is happening, poll quickly again after a state change
+        interval = initialInterval if stateChanged else min(interval * backoffFactor, maxInterval)
+        time.sleep(min(interval, remaining))
+
+    return jobInfo
+
+# helper function that blocks until a query job has finished running and returns its job info
+def waitForSalesforceQueryJob(jobId, session, uri):
     print('Waiting for query job to complete...')
-    jobComplete = False
+    with timedSpan('query.poll', jobId=jobId):
+        jsonRes = waitForSalesforceJobs([jobId], 'query', session, uri)[jobId]
+
+    if jsonRes['state'] != 'JobComplete':
+        print('Query job did not complete. State: ' + str(jsonRes['state']))
+        if jsonRes.get('errorMessage'):
+            print(jsonRes['errorMessage'])
+        sys.exit()
+
+    return jsonRes
+
+# generator that downloads the results of a completed query job one page at a time
+# each page holds at most maxRecords rows, so memory use depends on the page size and not on the size of the table
+def streamSalesforceQueryPages(jobId, session, uri, maxRecords=QUERY_PAGE_SIZE):
+    locator = None
+
+    while True:
+        params = {'maxRecords': maxRecords}
+        if locator:
+            params['locator'] = locator
+        # this only waits for the response headers: the body is downloaded (and decompressed) as the caller reads it,
+        # see streamResponseBody, so its download time is counted where it is read ('query.download')
+        with timedSpan('query.request', jobId=jobId):
+            response = session.get(uri+'query/'+jobId+'/results', params=params, headers=ACCEPT_GZIP_HEADERS, stream=True)
+
+        if response.status_code != 200:
+            print('Query results download failed:\n' + response.text)
+            print('status code: ' + str(response.status_code))
+            sys.exit()
 
-    while not jobComplete:
-        response = session.get(uri+'query/'+jobId)
-        jsonRes = response.json()
-        if str(jsonRes['state']) == 'JobComplete':
-            jobComplete = True
-        time.sleep(0.5)
+        try:
+            yield response
+        finally:
+            response.close()
 
-    # get job results
-    response = session.get(uri+'query/'+jobId+'/results')
-    s = str(response.content,'utf-8')
-    data = StringIO(s)
+        # Salesforce returns the string 'null' as the locator of the last page
+        locator = response.headers.get('Sforce-Locator')
+        if not locator or locator == 'null':
+            break
+
+# generator that runs a query and yields the results as a series of Pandas Dataframe chunks
+def streamDataframesFromSalesforce(query, session, uri, maxRecords=QUERY_PAGE_SIZE):
+    jobId = createSalesforceQueryJob(query, session, uri)
+
+    # wait for job to complete before getting results
+    waitForSalesforceQueryJob(jobId, session, uri)
+
+    yield from streamDataframesFromQueryJob(jobId, session, uri, maxRecords)
+
+# generator that yields the results of a completed query job as a series of Pandas Dataframe chunks
+def streamDataframesFromQueryJob(jobId, session, uri, maxRecords=QUERY_PAGE_SIZE):
+    # parse each page while it downloads, skipping pages with no rows
+    # (downloading and parsing overlap, so both are timed in one span)
+    for response in streamSalesforceQueryPages(jobId, session, uri, maxRecords):
+        with timedSpan('query.download', jobId=jobId):
+            try:
+                df = pd.read_csv(streamResponseBody(response))
+            except pd.errors.EmptyDataError:
+                continue
+        incrementCounter('query_records', len(df))
+        yield df
+
+# function to run a query and write the results straight to a CSV file without holding the full result set in memory
+def writeSalesforceQueryToCSV(query, path, session, uri, maxRecords=QUERY_PAGE_SIZE):
+    jobId = createSalesforceQueryJob(query, session, uri)
+
+    # wait for job to complete before getting results
+    waitForSalesforceQueryJob(jobId, session, uri)
+
+    # every page starts with its own header row, so only keep the header of the first page
+    headerWritten = False
+    with open(path, 'wb') as f:
+        for response in streamSalesforceQueryPages(jobId, session, uri, maxRecords):
+            skipHeader = headerWritten
+            for piece in response.iter_content(TRANSFER_CHUNK_BYTES):
+                if skipHeader:
+                    if b'\n' not in piece:
+                        continue
+                    piece = piece.split(b'\n', 1)[1]
+                    skipHeader = False
+                if piece.strip() or headerWritten:
+                    f.write(piece)
+                    headerWritten = True
 
-    df = pd.read_csv(data)
+    print('Done.\n')
+
+# function to query Salesforce and return a Pandas Dataframe, with the compact column types of SALESFORCE_FIELD_TYPES
+def getDataframeFromSalesforce(query, session, uri):
+    # each page is converted as it arrives, so only one page at a time is held with object columns
+    chunks = [applySalesforceFieldTypes(chunk) for chunk in streamDataframesFromSalesforce(query, session, uri)]
+
+    # categories can differ between pages (and then concat falls back to object columns), so types are applied again
+    df = applySalesforceFieldTypes(pd.concat(chunks, ignore_index=True)) if chunks else pd.DataFrame()
+    del chunks
     print('Done.\n')
     return df
 
-# function to create and execute a Salesforce bulk upload or delete job
-def executeSalesforceIngestJob(operation, importData, objectType, session, uri):    
+# helper function to read a streamed response body as a file, decompressing it as it is read
+def streamResponseBody(response):
+    response.raw.decode_content = True
+    return response.raw
+
+# generator that writes a Dataframe as UTF-8 CSV rows without a header, as (number of rows, bytes) blocks
+# blocks bigger than maxBytes are written again in halves, so one block always fits in one upload
+def iterateCSVBlocks(df, blockRows=CSV_WRITE_BLOCK_ROWS, maxBytes=INGEST_CHUNK_MAX_BYTES):
+    for start in range(0, len(df), blockRows):
+        block = df.iloc[start:start+blockRows]
+        data = block.to_csv(index=False, header=False).encode('utf-8')
+        if len(data) > maxBytes and len(block) > 1:
+            yield from iterateCSVBlocks(block, max(1, len(block) // 2), maxBytes)
+        else:
+            yield len(block), data
+
+# helper function to start a gzip-compressed upload body, returns (buffer, gzip writer)
+def openGzipUploadBody():
+    body = BytesIO()
+    return body, gzip.GzipFile(fileobj=body, mode='wb', compresslevel=GZIP_COMPRESSION_LEVEL, mtime=0)
+
+# helper function to finish a gzip-compressed upload body, returns the buffer ready to be sent
+def closeGzipUploadBody(body, writer):
+    writer.close()
+    body.seek(0)
+    return body
+
+# function to build the gzip-compressed CSV body of an upload from a Dataframe or CSV text
+# the CSV is compressed as it is written, so the uncompressed upload is never held in memory all at once
+# an already built body (a file object, see splitDataframeIntoUploadBodies) is returned as it is
+def compressUploadBody(importData):
+    if hasattr(importData, 'read'):
+        importData.seek(0)
+        return importData
+
+    body, writer = openGzipUploadBody()
+    if isinstance(importData, pd.DataFrame):
+        writer.write(importData.iloc[:0].to_csv(index=False).encode('utf-8'))
+        for _, data in iterateCSVBlocks(importData):
+            writer.write(data)
+    else:
+        for start in range(0, len(importData), TRANSFER_CHUNK_BYTES):
+            writer.write(importData[start:start+TRANSFER_CHUNK_BYTES].encode('utf-8'))
+    return closeGzipUploadBody(body, writer)
+
+# generator that splits a Dataframe into gzip-compressed upload bodies of at most maxBytes of CSV (and maxRows rows)
+# each body starts with the header row; the Dataframe is written to CSV once, one block at a time
+def splitDataframeIntoUploadBodies(df, maxBytes=INGEST_CHUNK_MAX_BYTES, maxRows=INGEST_CHUNK_MAX_ROWS):
+    header = df.iloc[:0].to_csv(index=False).encode('utf-8')
+    body, writer = None, None
+    for blockRows, data in iterateCSVBlocks(df, min(CSV_WRITE_BLOCK_ROWS, maxRows), maxBytes - len(header)):
+        if body is not None and (bodyBytes + len(data) > maxBytes or bodyRows + blockRows > maxRows):
+            yield closeGzipUploadBody(body, writer)
+            body = None
+        if body is None:
+            body, writer = openGzipUploadBody()
+            writer.write(header)
+            bodyBytes, bodyRows = len(header), 0
+        writer.write(data)
+        bodyBytes += len(data)
+        bodyRows += blockRows
+    if body is not None:
+        yield closeGzipUploadBody(body, writer)
+
+# function to create a Salesforce bulk upload or delete job, add the data to it, and close it
+# importData is a Dataframe, CSV text, or a body built by splitDataframeIntoUploadBodies; it is uploaded gzip-compressed
+# returns the job ID; Salesforce starts processing the job as soon as this returns
+# if a run being resumed already sent the same data, its job ID is returned instead (see the run journal)
+# upsert jobs match records on externalIdFieldName (e.g. 'Volunteer_Id__c')
+def submitSalesforceIngestJob(operation, importData, objectType, session, uri, externalIdFieldName=None):
     # create data import job
-    data = json.dumps({
+    jobDefinition = {
        "operation":operation,
        "object":objectType,
        "contentType":"CSV",
        "lineEnding":"LF"
-    })
-    response = session.post(uri+'ingest/', data=data)
+    }
+    if externalIdFieldName is not None:
+        jobDefinition['externalIdFieldName'] = externalIdFieldName
+    data = json.dumps(jobDefinition)
+
+    # the upload body is built first: its hash identifies the job in the run journal
+    # (bodies built by splitDataframeIntoUploadBodies are already compressed, and timed where they were built)
+    if hasattr(importData, 'read'):
+        body = compressUploadBody(importData)
+    else:
+        with timedSpan('ingest.compress', object=objectType):
+            body = compressUploadBody(importData)
+    payloadHash = hashUploadPayload(operation, objectType, externalIdFieldName, body)
+
+    # re-attach to the job of an earlier, unfinished run that was sent the same data instead of sending it again
+    jobId = findJournaledIngestJob(payloadHash)
+    if jobId is not None:
+        print('Re-attached to job ' + jobId + ' from the earlier run.')
+        incrementCounter('jobs_reattached')
+        invalidateQueryCache(objectType)
+        return jobId
+
+    with timedSpan('ingest.create', object=objectType, operation=operation):
+        response = session.post(uri+'ingest/', data=data, headers=JSON_HEADERS)
 
     if response.status_code == 200:
         if operation == 'insert':
@@ -120,6 +1125,8 @@ def executeSalesforceIngestJob(operation, importData, objectType, session, uri):
             print('Delete job created.')
         elif operation == 'update':
             print('Update job created.')
+        elif operation == 'upsert':
+            print('Upsert job created.')
     else:
         if operation == 'insert':
             print('Upload job creation failed.')
@@ -127,14 +1134,20 @@ def executeSalesforceIngestJob(operation, importData, objectType, session, uri):
             print('Delete job creation failed.')
         elif operation == 'update':
             print('Update job creation failed.')
+        elif operation == 'upsert':
+            print('Upsert job creation failed.')
         print(response.json())
         sys.exit()
 
     jobId = response.json().get('id')
+    recordJournaledIngestJob(payloadHash, jobId, objectType, operation, 'Open')
+
+    # cached query results for this object are stale from now on
+    invalidateQueryCache(objectType)
 
     # add data to job
-    session.headers.update({'Content-Type': 'text/csv;charset=UTF-8'})
-    response = session.put(uri+'ingest/'+jobId+'/batches', data=importData.encode('utf-8'))
+    with timedSpan('ingest.upload', jobId=jobId):
+        response = session.put(uri+'ingest/'+jobId+'/batches', data=body, headers=CSV_GZIP_HEADERS)
 
     if response.status_code == 201:
         print('Data added to job.')
@@ -144,43 +1157,978 @@ def executeSalesforceIngestJob(operation, importData, objectType, session, uri):
         sys.exit()
 
     # close the job => Salesforce begins processing the job
-    session.headers.update({'Content-Type': 'application/json;charset=utf-8'})
     data = json.dumps({ 'state': 'UploadComplete' })
-    response = session.patch(uri+'ingest/'+jobId, data=data)
+    with timedSpan('ingest.close', jobId=jobId):
+        response = session.patch(uri+'ingest/'+jobId, data=data, headers=JSON_HEADERS)
+    recordJournaledIngestJob(payloadHash, jobId, objectType, operation, 'UploadComplete')
 
-    # wait for job to complete before getting results
-    print('Waiting for job to complete...')
-    jobComplete = False
+    return jobId
 
-    while not jobComplete:
-        response = session.get(uri+'ingest/'+jobId)
-        jsonRes = response.json()
-        if str(jsonRes['state']) == 'JobComplete':
-            jobComplete = True
-        elif str(jsonRes['state']) == 'Failed':
-            print('Job Failed. Please check Salesforce: Setup > Bulk Data Load Jobs')
+# function to check the final job info of a finished ingest job and collect its results
+# returns a dict with the job ID, the processed and failed record counts, and the failed records as CSV text
+# with successfulResults=True the dict also holds a Dataframe of the successful records (sf__Id, sf__Created and the uploaded fields)
+def getSalesforceIngestJobResults(jobId, jsonRes, session, uri, successfulResults=False):
+    # drop results cached while the job was running (all of them if the job info couldn't be read)
+    if 'object' in jsonRes:
+        invalidateQueryCache(jsonRes['object'])
+    else:
+        clearQueryCache()
+
+    if jsonRes['state'] != 'JobComplete':
+        if jsonRes['state'] in TERMINAL_JOB_STATES:
+            print('Job ' + str(jsonRes['state']) + '. Please check Salesforce: Setup > Bulk Data Load Jobs')
+        else:
+            print('Timed out waiting for job ' + jobId + '. Please check Salesforce: Setup > Bulk Data Load Jobs')
+        if jsonRes.get('errorMessage'):
             print(jsonRes['errorMessage'])
-            sys.exit()
-        time.sleep(0.25)
-    
-    if operation == 'insert':
-        print('Upload complete!\n')
-    elif operation == 'delete':
-        print('Deletion complete.\n')
-    
-    # get job results to display to user
+        sys.exit()
+
+    incrementCounter('records_processed', jsonRes['numberRecordsProcessed'])
+    incrementCounter('records_failed', jsonRes['numberRecordsFailed'])
+
+    # display job results to user
     print('Job results:')
-    response = session.get(uri+'ingest/'+jobId)
-    jsonRes = response.json()
     print('Records processed: ' + str(jsonRes['numberRecordsProcessed']))
     print('Records failed: ' + str(jsonRes['numberRecordsFailed']) + '\n')
+    failedResults = ''
     if jsonRes['numberRecordsFailed'] > 0:
-        response = session.get(uri+'ingest/'+jobId+'/failedResults')
+        with timedSpan('ingest.results', jobId=jobId):
+            response = session.get(uri+'ingest/'+jobId+'/failedResults', headers=ACCEPT_GZIP_HEADERS)
+        failedResults = response.text
         print('---ERROR MESSAGE---')
-        print(response.text)
+        print(failedResults)
         print('-------------------')
         print('Please check Salesforce for further explanation: Setup > Bulk Data Load Jobs\n')
+
+    result = {
+        'jobIds': [jobId],
+        'numberRecordsProcessed': jsonRes['numberRecordsProcessed'],
+        'numberRecordsFailed': jsonRes['numberRecordsFailed'],
+        'failedResults': failedResults
+    }
+    if successfulResults:
+        result['successfulResults'] = getSalesforceIngestJobSuccessfulResults(jobId, session, uri)
+
+    return result
+
+# function to download the successful records of an ingest job as a Pandas Dataframe
+# sf__Id holds the Salesforce ID of each created or updated record
+def getSalesforceIngestJobSuccessfulResults(jobId, session, uri):
+    with timedSpan('ingest.results', jobId=jobId):
+        response = session.get(uri+'ingest/'+jobId+'/successfulResults', headers=ACCEPT_GZIP_HEADERS, stream=True)
+
+    with response:
+        if response.status_code != 200:
+            print('Successful results download failed:\n' + response.text)
+            sys.exit()
+
+        try:
+            return pd.read_csv(streamResponseBody(response))
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame(columns=['sf__Id', 'sf__Created'])
+
+# function to parse the failed results CSV of an ingest job into a Pandas Dataframe
+# values are kept as strings so that the records can be sent again exactly as they were uploaded
+def parseFailedResults(failedResults):
+    if not failedResults.strip():
+        return pd.DataFrame(columns=['sf__Id', 'sf__Error'])
+    return pd.read_csv(StringIO(failedResults), dtype=str, keep_default_na=False)
+
+# function to flag the failed records whose error is worth retrying (e.g. lock contention), see RETRYABLE_INGEST_ERRORS
+def isRetryableIngestError(failedDF):
+    errorCodes = failedDF['sf__Error'].str.extract(r'^([A-Z_]+)', expand=False)
+    return errorCodes.isin(RETRYABLE_INGEST_ERRORS)
+
+# function to resubmit only the records of a finished ingest job that failed with retryable errors
+# retries run one batch at a time, with smaller batches and a longer pause on every attempt
+# returns the result dict with the retried records' outcomes merged in; failedResults only holds records that still failed
+def retryFailedIngestRecords(operation, result, objectType, session, uri, successfulResults=False, externalIdFieldName=None, maxRetries=INGEST_MAX_RETRIES):
+    failedDF = parseFailedResults(result['failedResults'])
+    retryable = isRetryableIngestError(failedDF)
+    permanentFailures = [failedDF[~retryable]]
+    retryDF = failedDF[retryable]
+    successfulDFs = [result['successfulResults']] if successfulResults else []
+    jobIds = list(result['jobIds'])
+    batchSize = INGEST_RETRY_BATCH_SIZE
+    attempt = 0
+
+    while not retryDF.empty and attempt < maxRetries:
+        attempt += 1
+        incrementCounter('records_retried', len(retryDF))
+        print('Retrying ' + str(len(retryDF)) + ' records that failed with retryable errors (attempt ' + str(attempt) + ' of ' + str(maxRetries) + ')...\n')
+        time.sleep(INGEST_RETRY_DELAY * attempt)
+
+        stillFailing = []
+        for start in range(0, len(retryDF), batchSize):
+            batch = retryDF.iloc[start:start+batchSize].drop(columns=['sf__Id', 'sf__Error'])
+            batchResult = executeSalesforceIngestJob(operation, batch, objectType, session, uri, successfulResults, externalIdFieldName, maxRetries=0)
+            jobIds += batchResult['jobIds']
+            if successfulResults:
+                successfulDFs.append(batchResult['successfulResults'])
+            stillFailing.append(parseFailedResults(batchResult['failedResults']))
+
+        failedDF = pd.concat(stillFailing, ignore_index=True)
+        retryable = isRetryableIngestError(failedDF)
+        permanentFailures.append(failedDF[~retryable])
+        retryDF = failedDF[retryable]
+        batchSize = max(1, batchSize // 2)
+
+    # records that kept failing with retryable errors are reported along with the permanent failures
+    permanentFailures.append(retryDF)
+    failedDF = pd.concat(permanentFailures, ignore_index=True)
+    print('Records still failed after retries: ' + str(len(failedDF)) + '\n')
+
+    retried = {
+        'jobIds': jobIds,
+        'numberRecordsProcessed': result['numberRecordsProcessed'],
+        'numberRecordsFailed': len(failedDF),
+        'failedResults': failedDF.to_csv(index=False) if not failedDF.empty else ''
+    }
+    if successfulResults:
+        retried['successfulResults'] = pd.concat(successfulDFs, ignore_index=True)
+    return retried
+
+# function to create and execute a Salesforce bulk upload or delete job from a Dataframe (or CSV text)
+# returns a dict with the job ID, the processed and failed record counts, and the failed records as CSV text
+# (plus the successful records as a Dataframe when successfulResults=True)
+# records that fail with retryable errors are resubmitted up to maxRetries times
+def executeSalesforceIngestJob(operation, importData, objectType, session, uri, successfulResults=False, externalIdFieldName=None, maxRetries=INGEST_MAX_RETRIES):
+    jobId = submitSalesforceIngestJob(operation, importData, objectType, session, uri, externalIdFieldName)
+
+    # wait for job to complete before getting results
+    print('Waiting for job to complete...')
+    with timedSpan('ingest.processing', jobId=jobId):
+        jsonRes = waitForSalesforceJobs([jobId], 'ingest', session, uri)[jobId]
+    recordJournaledJobStates({jobId: jsonRes})
+
+    if jsonRes['state'] == 'JobComplete':
+        if operation == 'insert':
+            print('Upload complete!\n')
+        elif operation == 'delete':
+            print('Deletion complete.\n')
+
+    result = getSalesforceIngestJobResults(jobId, jsonRes, session, uri, successfulResults)
+    if maxRetries > 0 and result['numberRecordsFailed'] > 0:
+        result = retryFailedIngestRecords(operation, result, objectType, session, uri, successfulResults, externalIdFieldName, maxRetries)
+    return result
+
+# generator that splits CSV text into pieces of at most maxBytes (and maxRows rows), each starting with the header row
+# splits only happen at row boundaries: a newline inside a quoted field does not end a row
+def splitCSVIntoChunks(csvData, maxBytes=INGEST_CHUNK_MAX_BYTES, maxRows=INGEST_CHUNK_MAX_ROWS):
+    lines = StringIO(csvData)
+    header = lines.readline()
+    headerBytes = len(header.encode('utf-8'))
+
+    chunkRows = []
+    chunkBytes = headerBytes
+    row = ''
+    inQuotes = False
+
+    for line in lines:
+        row += line
+        # an odd number of quotes on a line means a quoted field was opened or closed
+        if line.count('"') % 2 == 1:
+            inQuotes = not inQuotes
+        if inQuotes:
+            continue
+
+        rowBytes = len(row.encode('utf-8'))
+        if chunkRows and (chunkBytes + rowBytes > maxBytes or len(chunkRows) >= maxRows):
+            yield header + ''.join(chunkRows)
+            chunkRows = []
+            chunkBytes = headerBytes
+        chunkRows.append(row)
+        chunkBytes += rowBytes
+        row = ''
+
+    if row:
+        chunkRows.append(row)
+    if chunkRows:
+        yield header + ''.join(chunkRows)
+
+# helper function to combine the results of several ingest jobs into one result dict
+def mergeIngestJobResults(results):
+    merged = {
+        'jobIds': [],
+        'numberRecordsProcessed': 0,
+        'numberRecordsFailed': 0,
+        'failedResults': ''
+    }
+    successfulResults = [result['successfulResults'] for result in results if 'successfulResults' in result]
+    if successfulResults:
+        merged['successfulResults'] = pd.concat(successfulResults, ignore_index=True)
+
+    for result in results:
+        merged['jobIds'] += result['jobIds']
+        merged['numberRecordsProcessed'] += result['numberRecordsProcessed']
+        merged['numberRecordsFailed'] += result['numberRecordsFailed']
+
+        # keep the header row of the first failed results file only
+        failedResults = result['failedResults']
+        if failedResults:
+            if merged['failedResults']:
+                failedResults = failedResults.split('\n', 1)[1] if '\n' in failedResults else ''
+            elif not failedResults.endswith('\n'):
+                failedResults += '\n'
+            merged['failedResults'] += failedResults
+
+    return merged
+
+# function to split a large upload (a Dataframe or CSV text) into size-capped pieces and run them as parallel ingest jobs
+# at most maxWorkers jobs run at the same time; the results of all jobs are merged into one result dict
+def executeSalesforceIngestJobChunked(operation, importData, objectType, session, uri, successfulResults=False, externalIdFieldName=None, maxRetries=INGEST_MAX_RETRIES, maxBytes=INGEST_CHUNK_MAX_BYTES, maxRows=INGEST_CHUNK_MAX_ROWS, maxWorkers=INGEST_MAX_WORKERS):
+    # pieces are held gzip-compressed until they are uploaded
+    with timedSpan('ingest.compress', object=objectType):
+        if isinstance(importData, pd.DataFrame):
+            chunks = list(splitDataframeIntoUploadBodies(importData, maxBytes, maxRows))
+        else:
+            chunks = [compressUploadBody(chunk) for chunk in splitCSVIntoChunks(importData, maxBytes, maxRows)]
+
+    # small uploads don't need more than one job
+    if len(chunks) <= 1:
+        return executeSalesforceIngestJob(operation, chunks[0] if chunks else importData, objectType, session, uri, successfulResults, externalIdFieldName, maxRetries)
+
+    # upload all pieces in parallel, then wait on all of the jobs together
+    print('Splitting upload into ' + str(len(chunks)) + ' jobs.\n')
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        jobIds = list(executor.map(lambda chunk: submitSalesforceIngestJob(operation, chunk, objectType, session, uri, externalIdFieldName), chunks))
+
+    print('Waiting for ' + str(len(jobIds)) + ' jobs to complete...')
+    with timedSpan('ingest.processing', jobIds=jobIds):
+        jobInfo = waitForSalesforceJobs(jobIds, 'ingest', session, uri)
+    recordJournaledJobStates(jobInfo)
+    results = [getSalesforceIngestJobResults(jobId, jobInfo[jobId], session, uri, successfulResults) for jobId in jobIds]
+
+    merged = mergeIngestJobResults(results)
+    print('All jobs complete.')
+    print('Total records processed: ' + str(merged['numberRecordsProcessed']))
+    print('Total records failed: ' + str(merged['numberRecordsFailed']) + '\n')
+
+    if maxRetries > 0 and merged['numberRecordsFailed'] > 0:
+        merged = retryFailedIngestRecords(operation, merged, objectType, session, uri, successfulResults, externalIdFieldName, maxRetries)
+    return merged
     
+### PER-RUN QUERY CACHE
+
+# cache of query results: normalized SOQL => (queried object, Dataframe), least recently used first
+_queryCache = OrderedDict()
+_queryCacheLock = threading.Lock()
+
+# helper function to normalize SOQL text into a cache key
+# whitespace and case are normalized outside of quoted string literals only
+def normalizeSoql(query):
+    parts = re.split(r"('(?:[^'\\]|\\.)*')", query.strip())
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i]).casefold()
+    return ''.join(parts)
+
+# helper function to find the object a SOQL query reads from
+def getSoqlObject(query):
+    match = re.search(r'\bFROM\s+(\w+)', query, re.IGNORECASE)
+    return match.group(1).casefold() if match else None
+
+# function to add a query result to the cache, evicting the least recently used results when the cache is full
+def addToQueryCache(query, df):
+    key = normalizeSoql(query)
+    with _queryCacheLock:
+        _queryCache[key] = (getSoqlObject(query), df)
+        _queryCache.move_to_end(key)
+        while len(_queryCache) > 1 and (len(_queryCache) > QUERY_CACHE_MAX_ENTRIES or sum(len(cached) for _, cached in _queryCache.values()) > QUERY_CACHE_MAX_ROWS):
+            _queryCache.popitem(last=False)
+
+# function to look up a query result in the cache, returns None on a miss
+def getFromQueryCache(query):
+    key = normalizeSoql(query)
+    with _queryCacheLock:
+        entry = _queryCache.get(key)
+        if entry is None:
+            return None
+        _queryCache.move_to_end(key)
+        return entry[1]
+
+# function to drop all cached results of queries on an object (called whenever an ingest job touches the object)
+def invalidateQueryCache(objectType):
+    objectType = objectType.casefold()
+    with _queryCacheLock:
+        for key in [key for key, (cachedObject, _) in _queryCache.items() if cachedObject == objectType]:
+            del _queryCache[key]
+
+# function to drop every cached query result (called at the end of each run)
+def clearQueryCache():
+    with _queryCacheLock:
+        _queryCache.clear()
+
+# function to query Salesforce through the per-run cache, so identical SOQL only runs one query job
+# NOTE: the same Dataframe is returned to every caller, so treat it as read-only
+def getCachedDataframeFromSalesforce(query, session, uri):
+    df = getFromQueryCache(query)
+    if df is not None:
+        print('Using cached query results.\n')
+        return df
+
+    df = getDataframeFromSalesforce(query, session, uri)
+    addToQueryCache(query, df)
+    return df
+
+### PARTITIONED EXTRACTION
+
+# helper function to blank out the contents of the string literals of a SOQL query
+# the result has the same length, so clause positions found in it are also positions in the query
+def maskSoqlLiterals(query):
+    return re.sub(r"'(?:[^'\\]|\\.)*'", lambda match: "'" + ' ' * (len(match.group(0)) - 2) + "'", query)
+
+# function to add a condition to the WHERE clause of a SOQL query, adding a WHERE clause if there is none
+# e.g. addSoqlCondition("SELECT Id FROM Account WHERE Name = 'A' LIMIT 5", "Id < 'x'") => "SELECT Id FROM Account WHERE Id < 'x' AND Name = 'A' LIMIT 5"
+def addSoqlCondition(query, condition):
+    masked = maskSoqlLiterals(query)
+    clauseEnd = re.search(r'\s+(GROUP\s+BY|ORDER\s+BY|LIMIT|OFFSET)\b', masked, re.IGNORECASE)
+    clauseEnd = clauseEnd.start() if clauseEnd else len(query.rstrip())
+    where = re.search(r'\bWHERE\b', masked[:clauseEnd], re.IGNORECASE)
+    if where is None:
+        return query[:clauseEnd] + ' WHERE ' + condition + query[clauseEnd:]
+
+    # conditions joined by OR are wrapped in brackets, so the new condition applies to all of them
+    existing = query[where.end():clauseEnd].strip()
+    if re.search(r'\bOR\b', masked[where.end():clauseEnd], re.IGNORECASE):
+        existing = '(' + existing + ')'
+    return query[:where.start()] + 'WHERE ' + condition + ' AND ' + existing + query[clauseEnd:]
+
+# helper function to build the conditions of the disjoint ranges around a sorted list of boundary literals
+# e.g. field < b1, field >= b1 AND field < b2, field >= b2
+def buildRangeConditions(field, boundaries):
+    if len(boundaries) == 0:
+        return ['']
+    conditions = [field + ' < ' + boundaries[0]]
+    conditions += [field + ' >= ' + low + ' AND ' + field + ' < ' + high for low, high in zip(boundaries, boundaries[1:])]
+    conditions.append(field + ' >= ' + boundaries[-1])
+    return conditions
+
+# function to split an object into Id ranges holding about the same number of records
+# returns the conditions of the ranges and the number of records the object had
+# NOTE: boundaries are taken from every Id of the object, downloaded by one 'SELECT Id FROM <object>' job (read through the
+# per-run query cache) before any partition job starts; this costs a serial query job and about 20 bytes per record.
+# There is no cheaper way to find even boundaries: SOQL can't sample records and OFFSET stops at 2000 rows
+def getIdPartitionConditions(objectType, session, uri, partitions=QUERY_PARTITIONS):
+    ids = getCachedDataframeFromSalesforce('SELECT Id FROM ' + objectType, session, uri)['Id']
+    ids = np.sort(ids.dropna().astype(str).to_numpy(dtype=object))
+    if len(ids) == 0:
+        return [''], 0
+    boundaries = pd.unique(ids[[len(ids) * k // partitions for k in range(1, partitions)]])
+    return buildRangeConditions('Id', ["'" + boundary + "'" for boundary in boundaries]), len(ids)
+
+# function to split a date or datetime field into partitions windows of equal length between start and end
+# the first and last windows are open-ended, and records with no date get a partition of their own
+# (the datetime system fields are never empty)
+def getDatePartitionConditions(field, start, end, partitions=QUERY_PARTITIONS):
+    boundaries = pd.date_range(pd.Timestamp(start), pd.Timestamp(end), periods=partitions + 1)[1:-1]
+    if field in DATETIME_PARTITION_FIELDS:
+        return buildRangeConditions(field, list(pd.unique(boundaries.strftime('%Y-%m-%dT%H:%M:%SZ'))))
+    return [field + ' = null'] + buildRangeConditions(field, list(pd.unique(boundaries.strftime('%Y-%m-%d'))))
+
+# generator that splits a query into disjoint partitions and yields the results of each partition as a Dataframe
+# partitionBy is 'Id' (ranges of about equal size) or a date/datetime field such as 'CreatedDate' or 'Day_of_Pickup__c'
+# (windows between start and end); the query jobs of all partitions run at the same time, and up to maxWorkers download at once
+# partitions are yielded as their downloads finish (not in partition order), so at most maxWorkers of them are held in memory
+# the rows of every partition are checked against the number of records its job processed, and for Id partitions of
+# a query without conditions of its own, the total is checked against the number of Ids the ranges were built from
+def streamPartitionedDataframesFromSalesforce(query, session, uri, partitions=QUERY_PARTITIONS, partitionBy='Id', start=None, end=None, maxWorkers=QUERY_PARTITION_MAX_WORKERS):
+    # a LIMIT applies to each partition separately, so those queries run as a single job
+    if re.search(r'\bLIMIT\b', maskSoqlLiterals(query), re.IGNORECASE):
+        print('Queries with a LIMIT are not partitioned.')
+        yield pd.concat(list(streamDataframesFromSalesforce(query, session, uri)) or [pd.DataFrame()], ignore_index=True)
+        return
+
+    expectedTotal = None
+    if partitionBy == 'Id':
+        conditions, idCount = getIdPartitionConditions(re.search(r'\bFROM\s+(\w+)', query, re.IGNORECASE).group(1), session, uri, partitions)
+        # a query without conditions or grouping returns one row per Id
+        if not re.search(r'\b(WHERE|GROUP\s+BY)\b', maskSoqlLiterals(query), re.IGNORECASE):
+            expectedTotal = idCount
+    elif start is None or end is None:
+        print('Partitioning by ' + partitionBy + ' needs a start and end date.')
+        sys.exit()
+    else:
+        conditions = getDatePartitionConditions(partitionBy, start, end, partitions)
+    queries = [addSoqlCondition(query, condition) if condition else query for condition in conditions]
+    print('Splitting query into ' + str(len(queries)) + ' partitions by ' + partitionBy + '.')
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        jobIds = list(executor.map(lambda partitionQuery: createSalesforceQueryJob(partitionQuery, session, uri), queries))
+
+        print('Waiting for ' + str(len(jobIds)) + ' query jobs to complete...')
+        with timedSpan('query.poll', jobIds=jobIds):
+            jobInfo = waitForSalesforceJobs(jobIds, 'query', session, uri)
+        for jobId in jobIds:
+            if jobInfo[jobId]['state'] != 'JobComplete':
+                print('Query job ' + jobId + ' did not complete. State: ' + str(jobInfo[jobId]['state']))
+                if jobInfo[jobId].get('errorMessage'):
+                    print(jobInfo[jobId]['errorMessage'])
+                sys.exit()
+
+        # download the partitions in parallel, starting the next download only when a finished one has been handed back
+        downloadPartition = lambda jobId: pd.concat(list(streamDataframesFromQueryJob(jobId, session, uri)) or [pd.DataFrame()], ignore_index=True)
+        waiting = list(jobIds)
+        downloading = {}
+        total = 0
+        while waiting or downloading:
+            while waiting and len(downloading) < maxWorkers:
+                jobId = waiting.pop(0)
+                downloading[executor.submit(downloadPartition, jobId)] = jobId
+            done, _ = wait(downloading, return_when=FIRST_COMPLETED)
+            for future in done:
+                jobId = downloading.pop(future)
+                df = future.result()
+                expected = jobInfo[jobId]['numberRecordsProcessed']
+                if len(df) != expected:
+                    print('Query job ' + jobId + ' returned ' + str(len(df)) + ' rows, but processed ' + str(expected) + ' records.')
+                    sys.exit()
+                total += len(df)
+                yield df
+                del df
+
+    print('Downloaded ' + str(total) + ' rows from ' + str(len(jobIds)) + ' partitions.')
+
+    # records created or deleted since the Ids were read also change the total, but any other difference means missed records
+    if expectedTotal is not None and total != expectedTotal:
+        print('Warning: the partitions returned ' + str(total) + ' rows, but the Id ranges were built from ' + str(expectedTotal) + ' records.')
+
+# function to run a query as several partitions at the same time and return the results as one Pandas Dataframe
+# (see streamPartitionedDataframesFromSalesforce), with the compact column types of SALESFORCE_FIELD_TYPES
+def getPartitionedDataframeFromSalesforce(query, session, uri, partitions=QUERY_PARTITIONS, partitionBy='Id', start=None, end=None, maxWorkers=QUERY_PARTITION_MAX_WORKERS):
+    chunks = [applySalesforceFieldTypes(chunk) for chunk in streamPartitionedDataframesFromSalesforce(query, session, uri, partitions, partitionBy, start, end, maxWorkers) if not chunk.empty]
+    df = applySalesforceFieldTypes(pd.concat(chunks, ignore_index=True)) if chunks else pd.DataFrame()
+    del chunks
+
+    # partitions are disjoint, so a record showing up twice means its object changed during the download
+    if 'Id' in df.columns and df['Id'].duplicated().any():
+        print('Warning: ' + str(df['Id'].duplicated().sum()) + ' records were returned by more than one partition.')
+    print('Done.\n')
+    return df
+
+### LOCAL SNAPSHOT STORE
+
+# function to open the local snapshot store and make sure its watermarks table exists
+def openSnapshotStore(path=SNAPSHOT_DB_PATH):
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS snapshot_watermarks (object TEXT PRIMARY KEY, fields TEXT, watermark TEXT)')
+    return conn
+
+# function to bring the local snapshot of a Salesforce object up to date
+# the first refresh (or a refresh after SNAPSHOT_FIELDS changes) downloads the whole object page by page
+# later refreshes only download rows with a SystemModstamp at or after the last watermark, then remove deleted rows using an Id-only query
+def refreshSalesforceSnapshot(objectType, session, uri, path=SNAPSHOT_DB_PATH):
+    fields = SNAPSHOT_FIELDS[objectType] + ['SystemModstamp']
+    fieldList = ', '.join(fields)
+    table = '"' + objectType + '"'
+
+    conn = openSnapshotStore(path)
+    try:
+        row = conn.execute('SELECT fields, watermark FROM snapshot_watermarks WHERE object = ?', (objectType,)).fetchone()
+        fullRefresh = row is None or row[0] != fieldList or row[1] is None
+        watermark = None if fullRefresh else row[1]
+
+        if fullRefresh:
+            print('Downloading full snapshot of ' + objectType + '...')
+            query = 'SELECT ' + fieldList + ' FROM ' + objectType
+            # forget the old watermark first so an interrupted download starts over next time
+            conn.execute('DELETE FROM snapshot_watermarks WHERE object = ?', (objectType,))
+            conn.execute('DROP TABLE IF EXISTS ' + table)
+            conn.commit()
+        else:
+            print('Refreshing snapshot of ' + objectType + ' (changes since ' + watermark + ')...')
+            query = 'SELECT ' + fieldList + ' FROM ' + objectType + ' WHERE SystemModstamp >= ' + watermark
+
+        # write each page of changed rows into the snapshot, replacing older versions of the same rows
+        # (full downloads of large objects are split into partitions that download in parallel)
+        if fullRefresh and objectType in SNAPSHOT_PARTITIONS:
+            pages = streamPartitionedDataframesFromSalesforce(query, session, uri, SNAPSHOT_PARTITIONS[objectType])
+        else:
+            pages = streamDataframesFromSalesforce(query, session, uri)
+        for df in pages:
+            if df.empty:
+                continue
+            # (a full download starts from an empty table, so there are no older versions to replace)
+            tableExists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (objectType,)).fetchone()
+            if tableExists and not fullRefresh:
+                conn.executemany('DELETE FROM ' + table + ' WHERE Id = ?', ((recordId,) for recordId in df['Id']))
+            df.to_sql(objectType, conn, if_exists='append', index=False)
+            pageWatermark = df['SystemModstamp'].max()
+            if watermark is None or pageWatermark > watermark:
+                watermark = pageWatermark
+
+        tableExists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (objectType,)).fetchone()
+        if not tableExists:
+            conn.execute('CREATE TABLE ' + table + ' (' + ', '.join('"' + field + '"' for field in fields) + ')')
+        conn.execute('CREATE INDEX IF NOT EXISTS "' + objectType + '_Id" ON ' + table + ' (Id)')
+
+        # reconcile deletes: keep only the rows whose Id still exists in Salesforce
+        if not fullRefresh:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS live_ids (Id TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM live_ids')
+            for df in streamDataframesFromSalesforce('SELECT Id FROM ' + objectType, session, uri):
+                conn.executemany('INSERT OR IGNORE INTO live_ids VALUES (?)', ((recordId,) for recordId in df['Id']))
+            deleted = conn.execute('DELETE FROM ' + table + ' WHERE Id NOT IN (SELECT Id FROM live_ids)').rowcount
+            if deleted:
+                print('Removed ' + str(deleted) + ' deleted records from the snapshot.')
+
+        conn.execute('INSERT OR REPLACE INTO snapshot_watermarks VALUES (?, ?, ?)', (objectType, fieldList, watermark))
+        conn.commit()
+    finally:
+        conn.close()
+
+    print('Snapshot of ' + objectType + ' is up to date.\n')
+
+# function to refresh the local snapshot of a Salesforce object and return it as a Pandas Dataframe
+# with the compact column types of SALESFORCE_FIELD_TYPES
+# reads are memoized in the per-run query cache until an ingest job touches the object
+# NOTE: the same Dataframe is returned to every caller, so treat it as read-only
+# fields defaults to all fields kept in the snapshot (see SNAPSHOT_FIELDS)
+def getDataframeFromSnapshot(objectType, session, uri, fields=None, path=SNAPSHOT_DB_PATH):
+    if fields is None:
+        fields = SNAPSHOT_FIELDS[objectType]
+
+    # a snapshot read returns the same rows as the equivalent live query, so it shares that query's cache entry
+    query = 'SELECT ' + ', '.join(fields) + ' FROM ' + objectType
+    df = getFromQueryCache(query)
+    if df is not None:
+        print('Using cached snapshot of ' + objectType + '.\n')
+        return df
+
+    with timedSpan('snapshot.refresh', object=objectType):
+        refreshSalesforceSnapshot(objectType, session, uri, path)
+
+    conn = openSnapshotStore(path)
+    try:
+        df = pd.read_sql('SELECT ' + ', '.join('"' + field + '"' for field in fields) + ' FROM "' + objectType + '"', conn)
+    finally:
+        conn.close()
+    df = applySalesforceFieldTypes(df)
+    addToQueryCache(query, df)
+    return df
+
+### RESCUE CHANGE TRACKING
+
+# function to compute a content hash of every rescue row in one vectorized pass
+# returns the hashes as strings, since SQLite integers can't hold unsigned 64-bit values
+def computeRescueFingerprints(rescuesDF):
+    return pd.util.hash_pandas_object(rescuesDF, index=False).astype(str)
+
+# helper function to build the (rescue_id, food_type) key columns of a set of rescues
+# one rescue has a row per food type, so both columns are needed to identify a row
+# (whole-number rescue IDs read as floats, e.g. 123.0 when a column has gaps, are written without the decimals)
+def getRescueKeys(rescueIds, foodTypes):
+    numericIds = pd.to_numeric(pd.Series(rescueIds), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    isWhole = ~np.isnan(numericIds) & (numericIds % 1 == 0)
+    rescueIds = pd.Series(rescueIds).astype(str).to_numpy(dtype=object)
+    rescueIds[isWhole] = numericIds[isWhole].astype(np.int64).astype(str)
+    return pd.DataFrame({'rescue_id': rescueIds, 'food_type': pd.Series(foodTypes).astype(str).values})
+
+# function to load the change-tracking store: the fingerprint and Salesforce Id of every rescue row already sent
+def loadRescueFingerprints(path=SNAPSHOT_DB_PATH):
+    conn = openSnapshotStore(path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS rescue_fingerprints (rescue_id TEXT, food_type TEXT, fingerprint TEXT, sf_id TEXT, PRIMARY KEY (rescue_id, food_type))')
+        return pd.read_sql('SELECT rescue_id, food_type, fingerprint, sf_id FROM rescue_fingerprints', conn)
+    finally:
+        conn.close()
+
+# function to add or replace rows in the change-tracking store
+def saveRescueFingerprints(fingerprintsDF, path=SNAPSHOT_DB_PATH):
+    conn = openSnapshotStore(path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS rescue_fingerprints (rescue_id TEXT, food_type TEXT, fingerprint TEXT, sf_id TEXT, PRIMARY KEY (rescue_id, food_type))')
+        rows = fingerprintsDF[['rescue_id', 'food_type', 'fingerprint', 'sf_id']].itertuples(index=False, name=None)
+        conn.executemany('INSERT OR REPLACE INTO rescue_fingerprints VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+# function to save the fingerprints of the rescues about to be sent, until the next rescues are about to be sent
+# if the run stops before it records what was sent, the next run records the rescues with these (see recordJournaledFoodRescues)
+def savePendingRescueFingerprints(fingerprintsDF, path=SNAPSHOT_DB_PATH):
+    conn = openSnapshotStore(path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS pending_rescue_fingerprints (rescue_id TEXT, food_type TEXT, fingerprint TEXT, PRIMARY KEY (rescue_id, food_type))')
+        conn.execute('DELETE FROM pending_rescue_fingerprints')
+        rows = fingerprintsDF[['rescue_id', 'food_type', 'fingerprint']].itertuples(index=False, name=None)
+        conn.executemany('INSERT OR REPLACE INTO pending_rescue_fingerprints VALUES (?, ?, ?)', rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+# function to load the fingerprints saved by savePendingRescueFingerprints
+def loadPendingRescueFingerprints(path=SNAPSHOT_DB_PATH):
+    conn = openSnapshotStore(path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS pending_rescue_fingerprints (rescue_id TEXT, food_type TEXT, fingerprint TEXT, PRIMARY KEY (rescue_id, food_type))')
+        return pd.read_sql('SELECT rescue_id, food_type, fingerprint FROM pending_rescue_fingerprints', conn)
+    finally:
+        conn.close()
+
+# function to fill an empty change-tracking store from the rescues already in Salesforce
+# rows that match a Salesforce rescue on rescue ID, food type and weight are recorded as unchanged
+# rows that only match on rescue ID and food type are recorded with an empty fingerprint, so they are sent as updates
+def seedRescueFingerprints(rescuesDF, fingerprints, session, uri, path=SNAPSHOT_DB_PATH):
+    print('Change-tracking store is empty, seeding it from Salesforce...')
+    salesforceRescuesDF = getDataframeFromSnapshot('Food_Rescue__c', session, uri, ['Id', 'Rescue_Id__c', 'Food_Type__c', 'Weight__c'])
+    salesforceKeysDF = getRescueKeys(salesforceRescuesDF['Rescue_Id__c'], salesforceRescuesDF['Food_Type__c'])
+    salesforceKeysDF['sf_id'] = salesforceRescuesDF['Id'].values
+    salesforceKeysDF['sf_weight'] = pd.to_numeric(salesforceRescuesDF['Weight__c']).values
+    salesforceKeysDF = salesforceKeysDF.drop_duplicates(subset=['rescue_id', 'food_type'])
+
+    adminKeysDF = getRescueKeys(rescuesDF['rescue_id'], rescuesDF['food_type'])
+    adminKeysDF['fingerprint'] = fingerprints.values
+    adminKeysDF['weight'] = rescuesDF[' total_weight '].values
+
+    seedDF = pd.merge(adminKeysDF, salesforceKeysDF, on=['rescue_id', 'food_type'], how='inner')
+    seedDF.loc[seedDF['weight'].ne(seedDF['sf_weight']).fillna(True).astype(bool), 'fingerprint'] = ''
+    saveRescueFingerprints(seedDF, path)
+    print('Recorded ' + str(len(seedDF)) + ' rescues already in Salesforce.\n')
+
+# function to split the admin rescues into new and changed rows using the change-tracking store
+# returns (new rescues, changed rescues with their Salesforce 'Id', fingerprints of both)
+def classifyFoodRescues(rescuesDF, session, uri, path=SNAPSHOT_DB_PATH):
+    # one row per (rescue_id, food_type), keeping the last row of any duplicates
+    rescuesDF = rescuesDF.drop_duplicates(subset=['rescue_id', 'food_type'], keep='last').reset_index(drop=True)
+    fingerprints = computeRescueFingerprints(rescuesDF)
+
+    storedDF = loadRescueFingerprints(path)
+    if storedDF.empty:
+        seedRescueFingerprints(rescuesDF, fingerprints, session, uri, path)
+        storedDF = loadRescueFingerprints(path)
+
+    # vectorized lookup of every row's stored fingerprint
+    keysDF = getRescueKeys(rescuesDF['rescue_id'], rescuesDF['food_type'])
+    keysDF['fingerprint'] = fingerprints.values
+    comparedDF = pd.merge(keysDF, storedDF.rename(columns={'fingerprint': 'stored_fingerprint'}), on=['rescue_id', 'food_type'], how='left')
+
+    isNew = comparedDF['sf_id'].isnull().values
+    isChanged = ~isNew & (comparedDF['fingerprint'] != comparedDF['stored_fingerprint']).values
+
+    newRescuesDF = rescuesDF[isNew].reset_index(drop=True)
+    changedRescuesDF = rescuesDF[isChanged].reset_index(drop=True)
+    changedRescuesDF.insert(0, 'Id', comparedDF.loc[isChanged, 'sf_id'].values)
+    fingerprintsDF = comparedDF.loc[isNew | isChanged, ['rescue_id', 'food_type', 'fingerprint', 'sf_id']]
+    return newRescuesDF, changedRescuesDF, fingerprintsDF
+
+# function to record the rescues an ingest job sent successfully in the change-tracking store
+def recordSentFoodRescues(result, fingerprintsDF, path=SNAPSHOT_DB_PATH):
+    sentDF = result['successfulResults']
+    if sentDF.empty:
+        return
+
+    sentKeysDF = getRescueKeys(sentDF['Rescue_Id__c'], sentDF['Food_Type__c'])
+    sentKeysDF['sf_id'] = sentDF['sf__Id'].values
+    recordDF = pd.merge(sentKeysDF, fingerprintsDF.drop(columns=['sf_id']), on=['rescue_id', 'food_type'], how='inner')
+    saveRescueFingerprints(recordDF, path)
+
+# function to record the rescues sent by the finished ingest jobs of an earlier, unfinished run in the change-tracking store
+# the run may have stopped before recording them, and the rescues stage would otherwise insert them again
+# rows get the fingerprint the earlier run computed (see savePendingRescueFingerprints), or an empty one if there is none,
+# so rescues that changed in the admin tool since are sent as updates
+def recordJournaledFoodRescues(jobIds, session, uri, path=SNAPSHOT_DB_PATH):
+    # an empty store is seeded from Salesforce by the rescues stage, which picks these rescues up too
+    if not jobIds or loadRescueFingerprints(path).empty:
+        return
+
+    pendingDF = loadPendingRescueFingerprints(path)
+    for jobId in jobIds:
+        sentDF = getSalesforceIngestJobSuccessfulResults(jobId, session, uri)
+        if sentDF.empty or 'Rescue_Id__c' not in sentDF.columns or 'Food_Type__c' not in sentDF.columns:
+            continue
+
+        sentKeysDF = getRescueKeys(sentDF['Rescue_Id__c'], sentDF['Food_Type__c'])
+        sentKeysDF['sf_id'] = sentDF['sf__Id'].values
+        recordDF = pd.merge(sentKeysDF, pendingDF, on=['rescue_id', 'food_type'], how='left')
+        recordDF['fingerprint'] = recordDF['fingerprint'].fillna('')
+        saveRescueFingerprints(recordDF, path)
+        print('Recorded ' + str(len(recordDF)) + ' rescues sent by job ' + jobId + ' of the earlier run.')
+
+### RESCUE RECONCILIATION
+
+# helper function to parse a column of dates or datetimes into 'YYYY-MM-DD' strings (NA where a value can't be parsed)
+def toDateStrings(series):
+    return pd.to_datetime(series, errors='coerce').dt.strftime('%Y-%m-%d')
+
+# function to find the admin tool rescues that are past their pickup day but still not completed or canceled
+# returns one row per rescue with its ID, pickup date, state and link, oldest first
+def findOverdueRescues(rescuesDF, today=None):
+    if today is None:
+        today = datetime.date.today()
+    pickupDates = toDateStrings(rescuesDF['pickup_start'])
+    isOverdue = ~rescuesDF['rescue_state'].isin(['Complete', 'Canceled']) & pickupDates.notna() & (pickupDates.fillna('') < today.isoformat())
+
+    overdueDF = pd.DataFrame({
+        'rescue_id': rescuesDF['rescue_id'][isOverdue],
+        'pickup_date': pickupDates[isOverdue],
+        'rescue_state': rescuesDF['rescue_state'][isOverdue].astype(str),
+        'rescue_detail_url': rescuesDF['rescue_detail_url'][isOverdue]
+    })
+    return overdueDF.drop_duplicates(subset='rescue_id').sort_values('pickup_date', kind='stable').reset_index(drop=True)
+
+# function to compare the rescues in Salesforce with the admin tool export in one pass, returns a report dict of Dataframes:
+# onlyInSalesforce: Salesforce rescue rows whose rescue ID isn't in the admin tool
+# onlyInAdmin: completed or canceled admin tool rescue rows whose rescue ID isn't in Salesforce
+# foodTypeMismatches: rows of rescues in both whose food type is only on one side ('side' says which)
+# fieldMismatches: rows in both whose state, weight or pickup date differ ('differences' lists the fields)
+# overdueIncomplete: admin tool rescues past their pickup day that aren't completed or canceled (see findOverdueRescues)
+# rescuesDF defaults to the rescues export read with readAdminExport
+def buildRescueReconciliationReport(session, uri, rescuesDF=None, today=None):
+    salesforceDF = getDataframeFromSnapshot('Food_Rescue__c', session, uri, ['Id', 'Rescue_Id__c', 'Food_Type__c', 'Weight__c', 'State__c', 'Day_of_Pickup__c', 'Rescue_Detail_URL__c'])
+    if rescuesDF is None:
+        rescuesDF = readAdminExport('rescues')
+
+    # both sides keyed by (rescue_id, food_type), with the compared fields in the same format
+    # (admin tool states Complete/Canceled are stored as completed/canceled in Salesforce)
+    adminDF = getRescueKeys(rescuesDF['rescue_id'], rescuesDF['food_type'])
+    adminDF['admin_state'] = rescuesDF['rescue_state'].astype(object).replace({'Complete': 'completed', 'Canceled': 'canceled'}).values
+    adminDF['admin_weight'] = pd.to_numeric(rescuesDF[' total_weight '], errors='coerce').astype(float).values
+    adminDF['admin_pickup_date'] = toDateStrings(rescuesDF['pickup_start']).values
+    adminDF['rescue_detail_url'] = rescuesDF['rescue_detail_url'].values
+    adminDF = adminDF.drop_duplicates(subset=['rescue_id', 'food_type'], keep='last')
+
+    sfDF = getRescueKeys(salesforceDF['Rescue_Id__c'], salesforceDF['Food_Type__c'])
+    sfDF['Id'] = salesforceDF['Id'].values
+    sfDF['salesforce_state'] = salesforceDF['State__c'].astype(object).values
+    sfDF['salesforce_weight'] = pd.to_numeric(salesforceDF['Weight__c'], errors='coerce').astype(float).values
+    sfDF['salesforce_pickup_date'] = toDateStrings(salesforceDF['Day_of_Pickup__c']).values
+    sfDF['salesforce_url'] = salesforceDF['Rescue_Detail_URL__c'].values
+    sfDF = sfDF.drop_duplicates(subset=['rescue_id', 'food_type'])
+
+    # one outer merge classifies every row
+    with timedSpan('pandas.merge', step='rescue reconciliation', rows=len(adminDF) + len(sfDF)):
+        mergedDF = pd.merge(adminDF, sfDF, on=['rescue_id', 'food_type'], how='outer', indicator=True)
+    idInAdmin = mergedDF['rescue_id'].isin(adminDF['rescue_id'])
+    idInSalesforce = mergedDF['rescue_id'].isin(sfDF['rescue_id'])
+    isAdminOnly = mergedDF['_merge'] == 'left_only'
+    isSalesforceOnly = mergedDF['_merge'] == 'right_only'
+    isBoth = mergedDF['_merge'] == 'both'
+    isUploaded = mergedDF['admin_state'].isin(['completed', 'canceled'])
+
+    # field differences of rows in both (a value missing on one side only counts as a difference)
+    def differs(adminCol, salesforceCol):
+        adminValues, salesforceValues = mergedDF[adminCol], mergedDF[salesforceCol]
+        bothMissing = adminValues.isna() & salesforceValues.isna()
+        return isBoth & ~bothMissing & (adminValues != salesforceValues)
+    differences = pd.DataFrame({
+        'state': differs('admin_state', 'salesforce_state'),
+        'weight': differs('admin_weight', 'salesforce_weight'),
+        'pickup date': differs('admin_pickup_date', 'salesforce_pickup_date')
+    })
+    isMismatch = differences.any(axis=1)
+
+    salesforceColumns = ['Id', 'rescue_id', 'food_type', 'salesforce_state', 'salesforce_weight', 'salesforce_pickup_date', 'salesforce_url']
+    adminColumns = ['rescue_id', 'food_type', 'admin_state', 'admin_weight', 'admin_pickup_date', 'rescue_detail_url']
+    foodTypeMismatchesDF = mergedDF.loc[idInAdmin & idInSalesforce & ~isBoth & (isSalesforceOnly | isUploaded), ['rescue_id', 'food_type', 'Id', 'rescue_detail_url']]
+    foodTypeMismatchesDF.insert(2, 'side', np.where(isAdminOnly[foodTypeMismatchesDF.index], 'admin', 'salesforce'))
+    fieldMismatchesDF = mergedDF.loc[isMismatch, ['Id'] + adminColumns + ['salesforce_state', 'salesforce_weight', 'salesforce_pickup_date']]
+    fieldMismatchesDF.insert(3, 'differences', differences[isMismatch].apply(lambda row: ', '.join(row.index[row]), axis=1) if isMismatch.any() else [])
+
+    report = {
+        'generatedAt': datetime.datetime.now().isoformat(timespec='seconds'),
+        'onlyInSalesforce': mergedDF.loc[isSalesforceOnly & ~idInAdmin, salesforceColumns].reset_index(drop=True),
+        'onlyInAdmin': mergedDF.loc[isAdminOnly & ~idInSalesforce & isUploaded, adminColumns].reset_index(drop=True),
+        'foodTypeMismatches': foodTypeMismatchesDF.sort_values(['rescue_id', 'side'], kind='stable').reset_index(drop=True),
+        'fieldMismatches': fieldMismatchesDF.reset_index(drop=True),
+        'overdueIncomplete': findOverdueRescues(rescuesDF, today)
+    }
+    report['summary'] = {name: len(df) for name, df in report.items() if isinstance(df, pd.DataFrame)}
+
+    print('Rescue reconciliation:')
+    for name, count in report['summary'].items():
+        print('  ' + name + ': ' + str(count))
+    print()
+    return report
+
+# function to write a reconciliation report to a JSON file (every section as a list of records)
+def writeRescueReconciliationReport(report, path=RECONCILIATION_REPORT_PATH):
+    output = {}
+    for name, value in report.items():
+        output[name] = json.loads(value.to_json(orient='records', date_format='iso')) if isinstance(value, pd.DataFrame) else value
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('Reconciliation report written to ' + path)
+
+### DUPLICATE DETECTION
+
+# function to build the match keys of a column of names: folded case and accents, no punctuation, single spaces
+# e.g. "Trader Joe's #123" and "Trader Joes 123" both become "trader joes 123"
+def getDuplicateKeys(series):
+    keys = normalizeNames(series, casefold=True, unicodeFold=True)
+    return keys.str.replace(r'[^\w\s]', '', regex=True).str.replace(r'\s+', ' ', regex=True).str.strip()
+
+# function to count the characters of each key: returns a (keys x distinct characters) matrix of counts
+# (match keys are plain ASCII, so each key can be read as a row of bytes)
+def countKeyCharacters(keys):
+    byteMatrix = np.array([key.encode('ascii', errors='replace') for key in keys], dtype=bytes)
+    byteMatrix = byteMatrix.view(np.uint8).reshape(len(keys), -1)
+    rows, cols = np.nonzero(byteMatrix)
+    characters, columns = np.unique(byteMatrix[rows, cols], return_inverse=True)
+    counts = np.zeros((len(keys), len(characters)), dtype=np.int16)
+    np.add.at(counts, (rows, columns), 1)
+    return counts
+
+# function to find pairs of similar keys with a sorted neighbourhood: every key is only compared with the
+# next window - 1 keys, once sorted as written and once sorted back to front (to catch differences at the start)
+# keys must be unique; returns a list of (index, index, similarity) for the pairs at or above the threshold
+def findSimilarKeyPairs(keys, threshold=DUPLICATE_SIMILARITY_THRESHOLD, window=DUPLICATE_WINDOW_SIZE):
+    keys = pd.Series(keys, dtype=object)
+    if len(keys) < 2:
+        return []
+    lengths = keys.str.len().to_numpy()
+    characterCounts = countKeyCharacters(keys)
+    keyValues = keys.to_numpy()
+    pairs = []
+    for sortKeys in (keys, keys.str[::-1]):
+        order = np.argsort(sortKeys.to_numpy(), kind='stable')
+        for offset in range(1, min(window, len(keys))):
+            left, right = order[:-offset], order[offset:]
+            # the shared characters of two keys bound their similarity (the same bound as difflib's quick_ratio),
+            # so only the pairs that can reach the threshold go through the slower string matching
+            shared = np.minimum(characterCounts[left], characterCounts[right]).sum(axis=1)
+            possible = 2 * shared >= threshold * (lengths[left] + lengths[right])
+            for i, j in zip(left[possible], right[possible]):
+                score = difflib.SequenceMatcher(None, keyValues[i], keyValues[j], autojunk=False).ratio()
+                if score >= threshold:
+                    pairs.append((i, j, score))
+    return pairs
+
+# function to group the rows of a Dataframe whose names are candidate duplicates of each other
+# rows with the same match key are always grouped; rows with similar keys are grouped through findSimilarKeyPairs,
+# and groups are merged transitively (union-find), so the run time stays close to linear in the number of rows
+# returns the rows in a group of two or more, with 'Duplicate Group', 'Match Key' and 'Similarity' columns,
+# where Similarity is the best score linking the row's key into its group (1.0 for an exact key match)
+def findDuplicateClusters(df, colName, threshold=DUPLICATE_SIMILARITY_THRESHOLD, window=DUPLICATE_WINDOW_SIZE):
+    with timedSpan('duplicates', column=colName, rows=len(df)):
+        keys = getDuplicateKeys(df[colName])
+        hasKey = df[colName].notna() & (keys != '')
+        df, keys = df[hasKey], keys[hasKey]
+
+        # work on the unique keys: rows sharing a key are exact duplicates
+        codes, uniqueKeys = pd.factorize(keys)
+        rowsPerKey = np.bincount(codes, minlength=len(uniqueKeys))
+        similarity = np.where(rowsPerKey > 1, 1.0, 0.0)
+
+        # union-find over the unique keys
+        parents = np.arange(len(uniqueKeys))
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, j, score in findSimilarKeyPairs(uniqueKeys, threshold, window):
+            parents[find(i)] = find(j)
+            similarity[i] = max(similarity[i], score)
+            similarity[j] = max(similarity[j], score)
+        groups = np.array([find(i) for i in range(len(uniqueKeys))], dtype=np.int64)
+
+        # keep the rows of groups with at least two rows, numbering the groups from 1
+        rowGroups = groups[codes]
+        isDuplicate = np.bincount(rowGroups, minlength=len(uniqueKeys))[rowGroups] > 1
+        duplicatesDF = df[isDuplicate].copy()
+        duplicatesDF['Duplicate Group'] = pd.factorize(rowGroups[isDuplicate], sort=True)[0] + 1
+        duplicatesDF['Match Key'] = keys[isDuplicate].to_numpy()
+        duplicatesDF['Similarity'] = similarity[codes[isDuplicate]].round(3)
+    return duplicatesDF.sort_values(['Duplicate Group', 'Match Key'], kind='stable').reset_index(drop=True)
+
+# function that returns candidate duplicate Food Donor Accounts (type ID: '0123t000000YYv2AAG') in Salesforce
+def findDuplicateFoodDonors(accountsDF, threshold=DUPLICATE_SIMILARITY_THRESHOLD):
+    return findDuplicateClusters(accountsDF[accountsDF['RecordTypeId'] == '0123t000000YYv2AAG'], 'Name', threshold)
+
+# function that returns candidate duplicate Nonprofit Partner Accounts (type ID: '0123t000000YYv3AAG') in Salesforce
+def findDuplicateNonprofitPartners(accountsDF, threshold=DUPLICATE_SIMILARITY_THRESHOLD):
+    return findDuplicateClusters(accountsDF[accountsDF['RecordTypeId'] == '0123t000000YYv3AAG'], 'Name', threshold)
+
+# function that returns candidate duplicate Volunteer Contacts in Salesforce (Volunteers belong to the Food Rescue Heroes Account, id: '0013t00001teMBwAAM')
+# NOTE: different volunteers can share a name, so compare the Volunteer_Id__c of each group before merging records
+def findDuplicateVolunteers(contactsDF, threshold=DUPLICATE_SIMILARITY_THRESHOLD):
+    return findDuplicateClusters(contactsDF[contactsDF['AccountId'] == '0013t00001teMBwAAM'], 'Name', threshold)
+
+### STAGE SCHEDULER
+
+# function to run one upload stage and return its outcome instead of raising
+# the API functions print the error and call sys.exit() when a request fails, so SystemExit is caught here
+# to stop one failed stage from ending the whole run
+def runStage(name, function):
+    print('Starting stage: ' + name)
+    start = time.perf_counter()
+    outcome = {'status': 'ok', 'error': None}
+    try:
+        with timedSpan('stage', stage=name):
+            function()
+    except SystemExit:
+        outcome = {'status': 'failed', 'error': 'stopped after a Salesforce API error (see the output above)'}
+    except Exception as e:
+        outcome = {'status': 'failed', 'error': type(e).__name__ + ': ' + str(e)}
+    outcome['seconds'] = round(time.perf_counter() - start, 3)
+    print('Finished stage: ' + name + ' (' + outcome['status'] + ')')
+    return outcome
+
+# function to run stages in dependency order, running independent stages at the same time
+# stages: name => (function with no arguments, list of names of the stages it depends on)
+# a stage starts as soon as all its dependencies succeeded; once all of them have finished, it is skipped if any of them
+# failed, was skipped or doesn't exist (all of those are named in its error)
+# completed: names of stages that already completed in an earlier run, which are not run again
+# returns name => {'status': 'ok' | 'done' | 'failed' | 'skipped', 'error': ..., 'seconds': ...} ('done': completed earlier)
+def runStages(stages, maxWorkers=STAGE_MAX_WORKERS, completed=()):
+    outcomes = {name: {'status': 'done', 'error': None, 'seconds': 0} for name in stages if name in completed}
+    pending = {name: stage for name, stage in stages.items() if name not in outcomes}
+    running = {}
+    for name in outcomes:
+        print('Stage already completed in an earlier run: ' + name)
+
+    with ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='stage') as executor:
+        while pending or running:
+            # start or skip every stage whose dependencies have all finished (dependencies that don't exist never run)
+            # (repeated until nothing changes, since skipping a stage can make its dependents skippable)
+            changed = True
+            while changed:
+                changed = False
+                for name, (function, dependencies) in list(pending.items()):
+                    if not all(d in outcomes or d not in stages for d in dependencies):
+                        continue
+                    failedDependencies = [d for d in dependencies if d in outcomes and outcomes[d]['status'] not in ('ok', 'done')]
+                    unknownDependencies = [d for d in dependencies if d not in stages]
+                    if failedDependencies or unknownDependencies:
+                        errors = []
+                        if failedDependencies:
+                            errors.append('depends on unsuccessful stage(s): ' + ', '.join(failedDependencies))
+                        if unknownDependencies:
+                            errors.append('unknown dependencies: ' + ', '.join(unknownDependencies))
+                        outcomes[name] = {'status': 'skipped', 'error': '; '.join(errors), 'seconds': 0}
+                        print('Skipping stage: ' + name + ' (' + outcomes[name]['error'] + ')')
+                    else:
+                        running[executor.submit(runStage, name, function)] = name
+                    del pending[name]
+                    changed = True
+
+            # stages left waiting with nothing running wait on each other
+            if not running:
+                for name in pending:
+                    outcomes[name] = {'status': 'skipped', 'error': 'circular dependencies between stages: ' + ', '.join(pending), 'seconds': 0}
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                outcomes[name] = future.result()
+
+    # report the outcomes in the order the stages were given
+    outcomes = {name: outcomes[name] for name in stages}
+    for name, outcome in outcomes.items():
+        recordStageOutcome(name, outcome)
+    return outcomes
+
+# function to print a summary table of stage outcomes
+def printStageOutcomes(outcomes):
+    print('\nStage results:')
+    for name, outcome in outcomes.items():
+        line = '  {:<12} {:<8} {:>9.1f}s'.format(name, outcome['status'], outcome['seconds'])
+        if outcome['error']:
+            line += '  ' + outcome['error']
+        print(line)
+
 ### WRAPPER FUNCTIONS
 
 # generic function to upload Account (both donor and nonprofit) data to Salesforce
@@ -188,145 +2136,151 @@ def uploadAccounts(salesforceAccountsDF, adminAccountsDF, accountType, session,
     # TODO add Total_Weight__c and Total_Rescues__c once new fields and hierarchy are in Salesforce
     adminAccountsDF.columns = ['Parent Name', 'Name', 'ShippingStreet', 'ShippingCity', 'ShippingState', 'ShippingPostalCode', 'County__c']
 
-    # clean Accounts data
-    salesforceAccountsDF = salesforceAccountsDF[salesforceAccountsDF['RecordTypeId'] == accountType]
-    salesforceAccountsDF = salesforceAccountsDF[['Id', 'Name']]
-    salesforceAccountsDF = salesforceAccountsDF.reset_index().drop(axis='columns', columns=['index'])
+    # clean Accounts data, using the cached normalized names of the full Salesforce frame
+    salesforceNames = getNormalizedNames(salesforceAccountsDF, 'Name')
+    isAccountType = salesforceAccountsDF['RecordTypeId'] == accountType
+    salesforceAccountsDF = pd.DataFrame({'Id': salesforceAccountsDF['Id'][isAccountType], 'Name': salesforceNames[isAccountType]})
     
-    # cleanup whitespace from names and parent names
-    salesforceAccountsDF = cleanupNameWhitespace(salesforceAccountsDF, 'Name')
+    # cleanup whitespace from admin names and parent names
     adminAccountsDF = cleanupNameWhitespace(adminAccountsDF, 'Parent Name')
     adminAccountsDF = cleanupNameWhitespace(adminAccountsDF, 'Name')
 
     # find all accounts in the admin tool not in salesforce
-    accountsNotInSalesforceDF = pd.merge(adminAccountsDF, salesforceAccountsDF, on='Name', how='left')
+    with timedSpan('pandas.merge', step='accounts not in Salesforce'):
+        accountsNotInSalesforceDF = pd.merge(adminAccountsDF, salesforceAccountsDF, on='Name', how='left')
     accountsNotInSalesforceDF = accountsNotInSalesforceDF[accountsNotInSalesforceDF['Id'].isnull()]
-    accountsNotInSalesforceDF = accountsNotInSalesforceDF.reset_index().drop(axis='columns', columns=['index', 'Id'])
+    accountsNotInSalesforceDF = accountsNotInSalesforceDF.drop(columns=['Id']).reset_index(drop=True)
 
     # add columns for ParentId and RecordTypeId
     accountsNotInSalesforceDF['ParentId'] = None
     accountsNotInSalesforceDF['RecordTypeId'] = accountType
 
-    # create empty dataframes for first and second upload jobs
-    uploadDFRows = []
-    uploadDF2Rows = []
-    
-    # iterate through accounts to determine parent-child relationships
-    for index, row in accountsNotInSalesforceDF.iterrows():
-        childName = row['Name']
-        parentName = row['Parent Name']
-        if (childName == parentName):
-            uploadDFRows.append(row.values)
-        elif (parentName in salesforceAccountsDF['Name'].values):
-            parentId = salesforceAccountsDF[salesforceAccountsDF['Name'] == parentName]['Id'].item()
-            row['ParentId'] = parentId
-            uploadDFRows.append(row.values)
-        else:
-            # create generic record for the new parent account
-            parentRow = [parentName, parentName, None, None, None, None, None, None, accountType]
-            uploadDFRows.append(parentRow)
-            # add child account to the second job
-            uploadDF2Rows.append(row.values)
-
-    # prepare dataframe for first upload
-    uploadDF = pd.DataFrame(uploadDFRows, columns=accountsNotInSalesforceDF.columns)
+    # look up each parent name in a name => Id index of the existing accounts
+    accountIds = buildNameIndex(salesforceAccountsDF, 'Name', 'Id')
+    parentIds = accountsNotInSalesforceDF['Parent Name'].map(accountIds)
+    isOwnParent = accountsNotInSalesforceDF['Name'] == accountsNotInSalesforceDF['Parent Name']
+    hasExistingParent = ~isOwnParent & parentIds.notnull()
+    needsNewParent = ~isOwnParent & parentIds.isnull()
+    accountsNotInSalesforceDF.loc[hasExistingParent, 'ParentId'] = parentIds[hasExistingParent]
+
+    # create generic records for new parent accounts that aren't already being uploaded as their own parent
+    newParentNames = accountsNotInSalesforceDF.loc[needsNewParent, 'Parent Name'].drop_duplicates()
+    newParentNames = newParentNames[~newParentNames.isin(accountsNotInSalesforceDF.loc[isOwnParent, 'Name'])]
+    newParentsDF = pd.DataFrame({'Parent Name': newParentNames, 'Name': newParentNames, 'RecordTypeId': accountType}, columns=accountsNotInSalesforceDF.columns)
+
+    # first job: accounts that are their own parent or have an existing parent, plus the new parents
+    # second job: child accounts whose parent is created by the first job
+    uploadDF = pd.concat([accountsNotInSalesforceDF[isOwnParent | hasExistingParent], newParentsDF], ignore_index=True)
     uploadDF.drop_duplicates(inplace=True)
-    uploadDF = uploadDF.reset_index().drop(axis='columns', columns=['Parent Name', 'index'])
+    uploadDF = uploadDF.drop(axis='columns', columns=['Parent Name'])
+    uploadDF2 = accountsNotInSalesforceDF[needsNewParent].reset_index(drop=True)
         
     # fix zip code formatting
-    if not uploadDF['ShippingPostalCode'].dtype == 'object':
+    if pd.api.types.is_numeric_dtype(uploadDF['ShippingPostalCode']):
         uploadDF['ShippingPostalCode'] = uploadDF['ShippingPostalCode'].astype('Int64')
     
-    # upload first job to Salesforce
-    executeSalesforceIngestJob('insert', uploadDF.to_csv(index=False), 'Account', session, uri)
+    if uploadDF.empty:
+        print('No new accounts to upload.\n')
+        return
+
+    # upload first job to Salesforce, keeping the IDs of the created accounts
+    result = executeSalesforceIngestJob('insert', uploadDF, 'Account', session, uri, successfulResults=True)
 
-    # pull down new list of Accounts
-    salesforceAccountsDF = getDataframeFromSalesforce('SELECT Id, Name, RecordTypeId FROM Account', session, uri)
+    if uploadDF2.empty:
+        return
 
-    # clean new Accounts data
-    salesforceAccountsDF = salesforceAccountsDF[salesforceAccountsDF['RecordTypeId'] == accountType]
-    salesforceAccountsDF = salesforceAccountsDF[['Id', 'Name']]
-    salesforceAccountsDF = salesforceAccountsDF.reset_index().drop(axis='columns', columns=['index'])
+    # add the new accounts to the name => Id index instead of downloading all Accounts again
+    # (if every account failed, the successful results are empty and have no Name column)
+    createdDF = result['successfulResults']
+    if not createdDF.empty and 'Name' in createdDF.columns:
+        createdDF['Name'] = createdDF['Name'].astype(str)
+        accountIds.update(buildNameIndex(createdDF, 'Name', 'sf__Id'))
 
     # attach ID of parent to each record
-    uploadDF2 = pd.DataFrame(uploadDF2Rows, columns=accountsNotInSalesforceDF.columns)
-    for index, row in uploadDF2.iterrows():
-        parentName = row['Parent Name']
-        parentId = salesforceAccountsDF[salesforceAccountsDF['Name'] == parentName]['Id'].item()
-        uploadDF2.at[index, 'ParentId'] = parentId
+    uploadDF2['ParentId'] = uploadDF2['Parent Name'].map(accountIds)
+
+    # skip children whose parent failed to upload
+    missingParent = uploadDF2['ParentId'].isnull()
+    if missingParent.any():
+        print('Skipping ' + str(missingParent.sum()) + ' accounts whose parent account failed to upload:')
+        print(uploadDF2.loc[missingParent, 'Name'].to_string(index=False) + '\n')
+        uploadDF2 = uploadDF2[~missingParent]
         
     # fix zip code formatting
-    if not uploadDF2['ShippingPostalCode'].dtype == 'object':
+    if pd.api.types.is_numeric_dtype(uploadDF2['ShippingPostalCode']):
         uploadDF2['ShippingPostalCode'] = uploadDF2['ShippingPostalCode'].astype('Int64')
 
     # drop parent name column and upload the new child accounts to salesforce
-    uploadDF2.drop(axis='columns', columns=['Parent Name'], inplace=True)    
-    executeSalesforceIngestJob('insert', uploadDF2.to_csv(index=False), 'Account', session, uri)
+    uploadDF2 = uploadDF2.drop(axis='columns', columns=['Parent Name'])
+    if not uploadDF2.empty:
+        executeSalesforceIngestJob('insert', uploadDF2, 'Account', session, uri)
     
 # generic function to upload Food Rescue data to Salesforce
-def uploadFoodRescues(rescuesDF, session, uri):
-    # load in Accounts from Salesforce
-    salesforceAccountsDF = getDataframeFromSalesforce('SELECT Id, Name, RecordTypeId FROM Account', session, uri)
+# for operation='update', rescuesDF must also have an 'Id' column with the Salesforce ID of each rescue
+def uploadFoodRescues(rescuesDF, session, uri, operation='insert'):
+    # load in Accounts from the local Salesforce snapshot
+    salesforceAccountsDF = getDataframeFromSnapshot('Account', session, uri, ['Id', 'Name', 'RecordTypeId'])
 
-    # load in Contacts from Salesforce
-    salesforceContactsDF = getDataframeFromSalesforce('SELECT Id, Name, Volunteer_Id__c FROM Contact', session, uri)
+    # load in Contacts from the local Salesforce snapshot
+    salesforceContactsDF = getDataframeFromSnapshot('Contact', session, uri, ['Id', 'Name', 'Volunteer_Id__c'])
 
     # cleanup rescuesDF
-    rescuesDF.drop(axis='columns', columns=['donor_name', 'recipient_name'], inplace=True)
+    rescuesDF = rescuesDF.drop(axis='columns', columns=['donor_name', 'recipient_name'], errors='ignore')
     rescuesDF = rescuesDF[(rescuesDF['rescue_state'] == 'Canceled') | (rescuesDF['rescue_state'] == 'Complete')]
-    rescuesDF = rescuesDF.reset_index().drop(axis='columns', columns='index')
+    rescuesDF = rescuesDF.reset_index(drop=True)
     
     # change new field values for rescue state (Complete, Canceled) to be compatible with Salesforce fields (completed, canceled)
     rescuesDF['rescue_state'] = rescuesDF['rescue_state'].str.replace('Complete', 'completed')
     rescuesDF['rescue_state'] = rescuesDF['rescue_state'].str.replace('Canceled', 'canceled')
 
+    # whitespace-normalized Salesforce names (cached per frame) to use in the vlookups below
+    salesforceAccountNames = getNormalizedNames(salesforceAccountsDF, 'Name')
+    salesforceContactNames = getNormalizedNames(salesforceContactsDF, 'Name')
+
     # get list of Food Donors
-    salesforceDonorsDF = salesforceAccountsDF[salesforceAccountsDF['RecordTypeId'] == '0123t000000YYv2AAG']
-    salesforceDonorsDF = salesforceDonorsDF[['Id', 'Name']]
-    salesforceDonorsDF = salesforceDonorsDF.reset_index().drop(axis='columns', columns=['index'])
-    salesforceDonorsDF.columns = ['Food_Donor_Account_Name__c', 'donor_location_name']
+    isDonor = salesforceAccountsDF['RecordTypeId'] == '0123t000000YYv2AAG'
+    salesforceDonorsDF = pd.DataFrame({'Food_Donor_Account_Name__c': salesforceAccountsDF['Id'][isDonor], 'donor_location_name': salesforceAccountNames[isDonor]})
 
     # get list of Nonprofit Partners
-    salesforcePartnersDF = salesforceAccountsDF[salesforceAccountsDF['RecordTypeId'] == '0123t000000YYv3AAG']
-    salesforcePartnersDF = salesforcePartnersDF[['Id', 'Name']]
-    salesforcePartnersDF = salesforcePartnersDF.reset_index().drop(axis='columns', columns=['index'])
-    salesforcePartnersDF.columns = ['Agency_Name__c', 'recipient_location_name']
+    isPartner = salesforceAccountsDF['RecordTypeId'] == '0123t000000YYv3AAG'
+    salesforcePartnersDF = pd.DataFrame({'Agency_Name__c': salesforceAccountsDF['Id'][isPartner], 'recipient_location_name': salesforceAccountNames[isPartner]})
 
     # get list of Volunteers
-    salesforceVolunteersDF = salesforceContactsDF[salesforceContactsDF['Volunteer_Id__c'].notnull()]
-    salesforceVolunteersDF = salesforceVolunteersDF[['Id', 'Name']]
-    salesforceVolunteersDF = salesforceVolunteersDF.reset_index().drop(axis='columns', columns=['index'])
-    salesforceVolunteersDF.columns = ['Volunteer_Name__c', 'volunteer']
-
-    # cleanup whitespace in name fields before performing vlookups
-    salesforceDonorsDF = cleanupNameWhitespace(salesforceDonorsDF, 'donor_location_name')
-    salesforcePartnersDF = cleanupNameWhitespace(salesforcePartnersDF, 'recipient_location_name')
-    salesforceVolunteersDF = cleanupNameWhitespace(salesforceVolunteersDF, 'volunteer')
+    isVolunteer = salesforceContactsDF['Volunteer_Id__c'].notnull()
+    salesforceVolunteersDF = pd.DataFrame({'Volunteer_Name__c': salesforceContactsDF['Id'][isVolunteer], 'volunteer': salesforceContactNames[isVolunteer]})
+
+    # cleanup whitespace in admin name fields before performing vlookups
     rescuesDF = cleanupNameWhitespace(rescuesDF, 'donor_location_name')
     rescuesDF = cleanupNameWhitespace(rescuesDF, 'recipient_location_name')
     rescuesDF['volunteer'] = rescuesDF['volunteer'].astype(str)
     rescuesDF = cleanupNameWhitespace(rescuesDF, 'volunteer')
 
     # Dataframe merges (vlookups) to add links to rescuesDF
-    mergedDF = pd.merge(rescuesDF, salesforceDonorsDF, on='donor_location_name', how='left')
-    mergedDF = pd.merge(mergedDF, salesforcePartnersDF, on='recipient_location_name', how='left')
-    mergedDF = pd.merge(mergedDF, salesforceVolunteersDF, on='volunteer', how='left')
+    with timedSpan('pandas.merge', step='rescue lookups', rows=len(rescuesDF)):
+        mergedDF = pd.merge(rescuesDF, salesforceDonorsDF, on='donor_location_name', how='left')
+        mergedDF = pd.merge(mergedDF, salesforcePartnersDF, on='recipient_location_name', how='left')
+        mergedDF = pd.merge(mergedDF, salesforceVolunteersDF, on='volunteer', how='left')
 
     # fix pickup_start column
     mergedDF['pickup_start'] = pd.to_datetime(mergedDF['pickup_start'], infer_datetime_format=True)
     mergedDF['pickup_start'] = mergedDF['pickup_start'].dt.date
 
     # fix columns to prepare for upload
-    mergedDF.drop(axis='columns', columns=['Unnamed: 0', 'donor_location_name', 'recipient_location_name', 'volunteer', 'estimated_quantity', 'reported_quantity', ' unit_weight ', 'volunteer_id'], inplace=True)
+    # (the unused export columns are only present if rescuesDF wasn't read with readAdminExport)
+    mergedDF.drop(axis='columns', columns=['Unnamed: 0', 'donor_location_name', 'recipient_location_name', 'volunteer', 'estimated_quantity', 'reported_quantity', ' unit_weight ', 'volunteer_id'], errors='ignore', inplace=True)
+    # (for updates, the Salesforce Id column is set aside while the remaining columns are renamed)
+    recordIds = mergedDF.pop('Id') if 'Id' in mergedDF.columns else None
     mergedDF.columns=['Rescue_Detail_URL__c', 'Rescue_Id__c', 'Day_of_Pickup__c', 'Food_Type__c', 'Description__c', 'Type__c', 'State__c', 'County__c', 'Weight__c', 'Food_Donor_Account_Name__c', 'Agency_Name__c', 'Volunteer_Name__c']
+    if recordIds is not None:
+        mergedDF.insert(0, 'Id', recordIds)
 
-    # upload rescues to Salesforce
-    executeSalesforceIngestJob('insert', mergedDF.to_csv(index=False), 'Food_Rescue__c', session, uri)
+    # upload rescues to Salesforce, keeping the successful records for the change-tracking store
+    return executeSalesforceIngestJobChunked(operation, mergedDF, 'Food_Rescue__c', session, uri, successfulResults=True)
 
 # wrapper function to upload Food Donors to Salesforce => purpose is to hide code from the IPYNB
 def uploadFoodDonors(accountsDF, session, uri):
     # load in donor data from admin tool
-    donorsDF = pd.read_csv('lastmile_donors.csv')
+    donorsDF = readAdminExport('donors')
 
     # filter out unnecessary data columns
     # NOTE: for donors, shipping street is currently just line1, line2 is NA for all records
@@ -339,7 +2293,7 @@ def uploadFoodDonors(accountsDF, session, uri):
 # wrapper function to upload Nonprofit Partners => purpose is to hide code from the IPYNB
 def uploadNonprofitPartners(accountsDF, session, uri):
     # load in partner data from admin tool
-    partnersDF = pd.read_csv('lastmile_partners.csv')
+    partnersDF = readAdminExport('partners')
 
     # filter out unnecessary data columns
     # TODO: add back Weight and rescues columns once new fields and hierarchy in Salesforce
@@ -357,7 +2311,7 @@ def uploadVolunteers(contactsDF, session, uri):
     salesforceVolunteersDF = contactsDF[contactsDF['Volunteer_Id__c'].notnull()]
     
     # load volunteer data from admin tool
-    volunteersDF = pd.read_csv('lastmile_volunteers.csv')
+    volunteersDF = readAdminExport('volunteers')
 
     # exclude volunteers who aren't Active from the upload
     volunteersDF = volunteersDF[volunteersDF['user_state'] == 'Active']
@@ -371,60 +2325,101 @@ def uploadVolunteers(contactsDF, session, uri):
 
     # do a merge to find all volunteers in the admin tool not in Salesforce
     # merge is done using unique Volunteer ID from the admin tool
-    volunteersNotInSalesforceDF = pd.merge(volunteersDF, salesforceVolunteersDF, on='Volunteer_Id__c', how='left')
+    with timedSpan('pandas.merge', step='volunteers not in Salesforce'):
+        volunteersNotInSalesforceDF = pd.merge(volunteersDF, salesforceVolunteersDF, on='Volunteer_Id__c', how='left')
     volunteersNotInSalesforceDF = volunteersNotInSalesforceDF[volunteersNotInSalesforceDF['Id'].isnull()]
-    volunteersNotInSalesforceDF = volunteersNotInSalesforceDF.reset_index().drop(axis='columns', columns=['index', 'Id'])
+    volunteersNotInSalesforceDF = volunteersNotInSalesforceDF.drop(columns=['Id']).reset_index(drop=True)
     
     # format phone numbers, clean up columns
     volunteersNotInSalesforceDF['Phone'] = volunteersNotInSalesforceDF['Phone'].astype('Int64')
     volunteersNotInSalesforceDF['Volunteer_Id__c'] = volunteersNotInSalesforceDF['Volunteer_Id__c'].astype('Int64')
     volunteersNotInSalesforceDF = volunteersNotInSalesforceDF[['Volunteer_Id__c', 'FirstName', 'LastName', 'Email', 'Phone', 'MailingStreet', 'MailingCity', 'MailingState', 'MailingPostalCode', 'County__c']]
     
+    if volunteersNotInSalesforceDF.empty:
+        print('No new volunteers to upload.\n')
+        return
+
     # upload Volunteers to Salesforce
-    executeSalesforceIngestJob('insert', volunteersNotInSalesforceDF.to_csv(index=False), 'Contact', session, uri)
+    # upsert on the admin tool's Volunteer ID, so a rerun after a partial failure can't create duplicate Contacts
+    executeSalesforceIngestJob('upsert', volunteersNotInSalesforceDF, 'Contact', session, uri, externalIdFieldName='Volunteer_Id__c')
 
-# wrapper function that finds all new Food Rescues and uploads them to Salesforce
+# wrapper function that finds all new and changed Food Rescues and uploads them to Salesforce
+# new rescues are inserted and changed rescues are sent as updates
 def uploadNewFoodRescues(session, uri):
     # read in all rescues from admin tool
-    rescuesDF = pd.read_csv('lastmile_rescues.csv')
+    rescuesDF = readAdminExport('rescues')
+
+    # clean up admin rescues due to new format ('Please assign weight' is read as NA)
+    rescuesDF = rescuesDF[rescuesDF[' total_weight '].notna()]
 
-    # read in all rescues currently in Salesforce
-    salesforceRescuesDF = getDataframeFromSalesforce('SELECT Id, Rescue_Id__c, Food_Type__c, Weight__c FROM Food_Rescue__c', session, uri).drop_duplicates()
-    salesforceRescuesDF.columns = ['Id', 'rescue_id', 'food_type', ' total_weight ']
+    # only completed and canceled rescues are uploaded, so the others aren't tracked either
+    rescuesDF = rescuesDF[rescuesDF['rescue_state'].isin(['Complete', 'Canceled'])]
 
-    # clarify types for total_weight column in both DFs
-    salesforceRescuesDF[' total_weight '] = salesforceRescuesDF[' total_weight '].astype(np.int64)
-    # clean up admin rescues due to new format
-    rescuesDF = rescuesDF[rescuesDF[' total_weight '] != 'Please assign weight']
-    rescuesDF[' total_weight '] = rescuesDF[' total_weight '].astype(np.int64)
+    # compare each rescue against the change-tracking store
+    with timedSpan('pandas.classify', step='rescue fingerprints', rows=len(rescuesDF)):
+        newRescuesDF, changedRescuesDF, fingerprintsDF = classifyFoodRescues(rescuesDF, session, uri)
+    print(str(len(newRescuesDF)) + ' new rescues, ' + str(len(changedRescuesDF)) + ' changed rescues.\n')
+    if not fingerprintsDF.empty:
+        savePendingRescueFingerprints(fingerprintsDF)
 
-    # find list of rescues not yet in Salesforce
-    mergedDF = pd.merge(rescuesDF, salesforceRescuesDF, on=['rescue_id', 'food_type', ' total_weight '], how='left')
-    mergedDF = mergedDF[mergedDF['Id'].isnull()]
-    mergedDF = mergedDF.reset_index().drop(axis='columns', columns=['index', 'Id'])
+    # upload new rescues to Salesforce
+    if not newRescuesDF.empty:
+        result = uploadFoodRescues(newRescuesDF, session, uri)
+        recordSentFoodRescues(result, fingerprintsDF)
 
-    # upload these new rescues to Salesforce
-    uploadFoodRescues(mergedDF, session, uri)
+    # send changed rescues to Salesforce as updates
+    if not changedRescuesDF.empty:
+        result = uploadFoodRescues(changedRescuesDF, session, uri, 'update')
+        recordSentFoodRescues(result, fingerprintsDF)
 
 # master function to upload new data to Salesforce (Accounts, Contacts, Rescues)
-def uploadDataToSalesforce(accountsDF, contactsDF, session, uri):
-    # first make sure all new Donors, Nonprofits, and Volunteers are uploaded to Salesforce
-    print('-----------------------------')
-    print('Checking for new Food Donors:')
-    print('-----------------------------')
-    uploadFoodDonors(accountsDF, session, uri)
-    print('------------------------------------')
-    print('Checking for new Nonprofit Partners:')
-    print('------------------------------------')
-    uploadNonprofitPartners(accountsDF, session, uri)
-    print('----------------------------')
-    print('Checking for new Volunteers:')
-    print('----------------------------')
-    uploadVolunteers(contactsDF, session, uri)
-    
-    # upload new rescue data
-    print('-------------------------------')
-    print('Uploading all new Food Rescues:')
-    print('-------------------------------')
-    uploadNewFoodRescues(session, uri)
+# Donors, Nonprofits and Volunteers are uploaded at the same time; Rescues are uploaded once all three succeeded
+# writes a run report with the timing of every step to reportPath, and Prometheus metrics to prometheusPath if given
+# progress is journaled to journalPath until every stage has completed; with resume=True a run that stopped partway
+# continues from the journal: completed stages are not run again and jobs that were already submitted are re-attached to
+# returns the outcome of each stage (see runStages)
+def uploadDataToSalesforce(accountsDF, contactsDF, session, uri, reportPath=RUN_REPORT_PATH, prometheusPath=None, maxWorkers=STAGE_MAX_WORKERS, resume=True, journalPath=RUN_JOURNAL_PATH):
+    # count the metrics of this run from zero; they stay readable with getRunReport until the next run starts
+    resetRunMetrics()
+
+    # normalized Salesforce names are cached for the length of the run
+    clearNormalizedNamesCache()
+
+    # a completed stage is run again if the exports it reads (or those of the stages it depends on) have changed
+    inputHashes = {
+        'donors': hashAdminExports(['donors']),
+        'partners': hashAdminExports(['partners']),
+        'volunteers': hashAdminExports(['volunteers']),
+        'rescues': hashAdminExports(['donors', 'partners', 'volunteers', 'rescues'])
+    }
+    startRunJournal(journalPath, resume)
+    settleJournaledIngestJobs(session, uri)
+    # the accounts and volunteers sent by the earlier run are read again, so the stages don't insert them a second time
+    accountsDF = refreshJournaledRecords(accountsDF, 'Account', session, uri)
+    contactsDF = refreshJournaledRecords(contactsDF, 'Contact', session, uri)
+    # rescues sent by the earlier run are recorded first, so the rescues stage doesn't send them again even if the export changed
+    recordJournaledFoodRescues(getResumableIngestJobIds('Food_Rescue__c'), session, uri)
+    completed = [name for name, inputsHash in inputHashes.items() if isStageJournaled(name, inputsHash)]
+
+    # NOTE: the output of stages running at the same time is interleaved
+    stages = {
+        'donors': (lambda: uploadFoodDonors(accountsDF, session, uri), []),
+        'partners': (lambda: uploadNonprofitPartners(accountsDF, session, uri), []),
+        'volunteers': (lambda: uploadVolunteers(contactsDF, session, uri), []),
+        'rescues': (lambda: uploadNewFoodRescues(session, uri), ['donors', 'partners', 'volunteers'])
+    }
+    stages = {name: (journaledStage(name, inputHashes[name], function), dependencies) for name, (function, dependencies) in stages.items()}
+    outcomes = runStages(stages, maxWorkers, completed)
+    printStageOutcomes(outcomes)
+
+    # the journal is kept until every stage has completed
+    stopRunJournal(delete=all(outcome['status'] in ('ok', 'done') for outcome in outcomes.values()))
+    clearNormalizedNamesCache()
+    clearQueryCache()
+
+    # export the metrics of this run
+    writeRunReport(reportPath)
+    if prometheusPath is not None:
+        writePrometheusTextfile(prometheusPath)
     print('\nDone!')
+    return outcomes
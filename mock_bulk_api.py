@@ -0,0 +1,374 @@
+### LOCAL STAND-IN FOR THE SALESFORCE BULK 2.0 API
+# in-memory org that implements the query and ingest endpoints used by functions.py, for benchmarks and dry runs
+# usage: python mock_bulk_api.py --port 8765 --latency 0.01 --processing-time 0.5
+# then point functions.py at uri = 'http://localhost:8765/services/data/v52.0/jobs/'
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+from io import StringIO
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+import numpy as np
+import argparse
+import gzip
+import datetime
+import threading
+import json
+import re
+import time
+
+# path prefix of the Bulk 2.0 jobs endpoints (same as the uri used in the notebook)
+JOBS_PATH = '/services/data/v52.0/jobs/'
+
+# key prefixes used to build fake 18-character record IDs
+KEY_PREFIXES = {'Account': '001', 'Contact': '003'}
+CUSTOM_KEY_PREFIX = 'a0X'
+
+# helper function to build the current time as a Salesforce datetime string
+def salesforceNow():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+# helper function to turn a SOQL literal into a Python value (strings lose their quotes, numbers become floats, null becomes None)
+def parseSoqlLiteral(literal):
+    if literal.lower() == 'null':
+        return None
+    if literal.startswith("'") and literal.endswith("'"):
+        return literal[1:-1].replace("\\'", "'")
+    try:
+        return float(literal)
+    except ValueError:
+        return literal
+
+# function to evaluate a simple SOQL query against a Dataframe of records
+# supports SELECT <fields> FROM <object> [WHERE <field> <op> <literal> [AND ...]] [ORDER BY <field>] [LIMIT <n>]
+def runSoql(query, records):
+    match = re.match(r'\s*SELECT\s+(.+?)\s+FROM\s+(\w+)(?:\s+WHERE\s+(.+?))?(?:\s+ORDER\s+BY\s+(\w+)(?:\s+(ASC|DESC))?)?(?:\s+LIMIT\s+(\d+))?\s*$', query, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        raise ValueError('Unsupported query: ' + query)
+    fields = [field.strip() for field in match.group(1).split(',')]
+    where, orderBy, direction, limit = match.group(3), match.group(4), match.group(5), match.group(6)
+
+    df = records
+    if where:
+        mask = pd.Series(True, index=df.index)
+        for condition in re.split(r'\s+AND\s+', where, flags=re.IGNORECASE):
+            condMatch = re.match(r"\s*(\w+)\s*(>=|<=|!=|=|>|<)\s*('(?:[^'\\]|\\.)*'|\S+)\s*$", condition)
+            if condMatch is None:
+                raise ValueError('Unsupported condition: ' + condition)
+            field, op, value = condMatch.group(1), condMatch.group(2), parseSoqlLiteral(condMatch.group(3))
+            column = df[field] if field in df.columns else pd.Series(None, index=df.index, dtype=object)
+            if value is None:
+                # empty values are stored as '' (and missing fields as None)
+                isNull = column.fillna('') == ''
+                mask &= isNull if op == '=' else ~isNull
+                continue
+            if isinstance(value, float):
+                column = pd.to_numeric(column, errors='coerce')
+            else:
+                column = column.fillna('').astype(str)
+                # like SOQL, empty values never match a range comparison
+                if op not in ('=', '!='):
+                    mask &= column != ''
+            if op == '=':
+                mask &= column == value
+            elif op == '!=':
+                mask &= column != value
+            elif op == '>=':
+                mask &= column >= value
+            elif op == '<=':
+                mask &= column <= value
+            elif op == '>':
+                mask &= column > value
+            else:
+                mask &= column < value
+        df = df[mask]
+    if orderBy:
+        df = df.sort_values(orderBy, ascending=(direction or 'ASC').upper() == 'ASC')
+    if limit:
+        df = df.head(int(limit))
+
+    return df.reindex(columns=fields)
+
+# in-memory org: one Dataframe of string values per object, plus the state of every query and ingest job
+class MockOrg:
+    def __init__(self, processingTime=0.5, pageSize=100000, failureRate=0.0, seed=0):
+        self.processingTime = processingTime
+        self.pageSize = pageSize
+        self.failureRate = failureRate
+        self.random = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    # function to drop all records, jobs and request counts
+    def reset(self):
+        with self.lock:
+            self.objects = {}
+            self.jobs = {}
+            self.idCounters = Counter()
+            self.requestCounts = Counter()
+
+    # helper function to create n new record IDs for an object
+    def newIds(self, objectType, n):
+        prefix = KEY_PREFIXES.get(objectType, CUSTOM_KEY_PREFIX)
+        start = self.idCounters[objectType] + 1
+        self.idCounters[objectType] += n
+        return [prefix + str(i).zfill(12) + 'AAA' for i in range(start, start + n)]
+
+    # helper function to create a new job ID
+    def newJobId(self):
+        return '750' + str(len(self.jobs) + 1).zfill(12) + 'AAA'
+
+    # function to add records directly, without going through an ingest job (used to seed benchmarks)
+    def seed(self, objectType, df):
+        with self.lock:
+            df = df.astype(object).where(df.notnull(), None)
+            df.insert(0, 'Id', self.newIds(objectType, len(df)))
+            df['SystemModstamp'] = salesforceNow()
+            self.objects[objectType] = pd.concat([self.objects.get(objectType), df], ignore_index=True)
+            return len(df)
+
+    # function to create a query job; the result set is fixed when the job is created
+    def createQueryJob(self, query):
+        with self.lock:
+            objectType = re.search(r'\bFROM\s+(\w+)', query, re.IGNORECASE).group(1)
+            records = self.objects.get(objectType, pd.DataFrame(columns=['Id']))
+            results = runSoql(query, records)
+            jobId = self.newJobId()
+            self.jobs[jobId] = {
+                'info': {'id': jobId, 'operation': 'query', 'object': objectType, 'state': 'UploadComplete', 'numberRecordsProcessed': 0},
+                'readyAt': time.monotonic() + self.processingTime,
+                'results': results
+            }
+            return self.jobs[jobId]['info']
+
+    # function to create an ingest job
+    def createIngestJob(self, definition):
+        with self.lock:
+            jobId = self.newJobId()
+            self.jobs[jobId] = {
+                'info': {'id': jobId, 'operation': definition['operation'], 'object': definition['object'], 'externalIdFieldName': definition.get('externalIdFieldName'),
+                         'state': 'Open', 'numberRecordsProcessed': 0, 'numberRecordsFailed': 0},
+                'data': []
+            }
+            return self.jobs[jobId]['info']
+
+    # function to add CSV data to an open ingest job
+    def addIngestData(self, jobId, body):
+        with self.lock:
+            job = self.jobs[jobId]
+            if job['info']['state'] != 'Open':
+                return False
+            job['data'].append(body)
+            return True
+
+    # function to change the state of an ingest job (UploadComplete starts processing, Aborted cancels it)
+    def setIngestJobState(self, jobId, state):
+        with self.lock:
+            job = self.jobs[jobId]
+            job['info']['state'] = state
+            if state == 'UploadComplete':
+                job['readyAt'] = time.monotonic() + self.processingTime
+            return job['info']
+
+    # function to return the current info of a job, finishing it first if its processing time is up
+    def getJobInfo(self, jobId):
+        with self.lock:
+            job = self.jobs[jobId]
+            if job['info']['state'] == 'UploadComplete' and time.monotonic() >= job['readyAt']:
+                if job['info']['operation'] == 'query':
+                    job['info']['numberRecordsProcessed'] = len(job['results'])
+                    job['info']['state'] = 'JobComplete'
+                else:
+                    self.processIngestJob(job)
+            return dict(job['info'])
+
+    # function to apply the data of an ingest job to the org (called with the lock held)
+    def processIngestJob(self, job):
+        info = job['info']
+        frames = [pd.read_csv(StringIO(body), dtype=str, keep_default_na=False) for body in job['data'] if body.strip()]
+        data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        objectType = info['object']
+        records = self.objects.get(objectType, pd.DataFrame(columns=['Id', 'SystemModstamp']))
+
+        # randomly fail some records with lock errors to exercise retries
+        failed = pd.Series(self.random.random(len(data)) < self.failureRate, index=data.index)
+        errors = pd.Series(None, index=data.index, dtype=object)
+        errors[failed] = 'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record:--'
+        sfIds = pd.Series(None, index=data.index, dtype=object)
+        created = pd.Series(False, index=data.index)
+        now = salesforceNow()
+
+        if info['operation'] in ('update', 'delete', 'upsert'):
+            keyField = info['externalIdFieldName'] if info['operation'] == 'upsert' else 'Id'
+            existing = pd.Series(records['Id'].values, index=records[keyField].values) if keyField in records.columns else pd.Series(dtype=object)
+            existing = existing[~existing.index.duplicated()]
+            sfIds[:] = data[keyField].map(existing).values if keyField in data.columns else None
+            if info['operation'] != 'upsert':
+                missing = sfIds.isnull() & ~failed
+                errors[missing] = 'INVALID_CROSS_REFERENCE_KEY:invalid cross reference id:--'
+                failed |= missing
+
+        ok = ~failed
+        if info['operation'] == 'delete':
+            records = records[~records['Id'].isin(sfIds[ok])]
+        else:
+            toCreate = ok & sfIds.isnull()
+            sfIds[toCreate] = self.newIds(objectType, int(toCreate.sum()))
+            created[toCreate] = True
+            changes = data[ok].drop(columns=['Id'], errors='ignore')
+            changes.insert(0, 'Id', sfIds[ok].values)
+            changes['SystemModstamp'] = now
+            # replace updated rows, then append the changed and created rows
+            records = records[~records['Id'].isin(changes['Id'])]
+            records = pd.concat([records, changes], ignore_index=True)
+        self.objects[objectType] = records
+
+        successful = data[ok].copy()
+        successful.insert(0, 'sf__Created', np.where(created[ok], 'true', 'false'))
+        successful.insert(0, 'sf__Id', sfIds[ok].values)
+        failedRecords = data[failed].copy()
+        failedRecords.insert(0, 'sf__Error', errors[failed].values)
+        failedRecords.insert(0, 'sf__Id', '')
+
+        job['successfulResults'] = successful
+        job['failedResults'] = failedRecords
+        job['data'] = []
+        info['numberRecordsProcessed'] = len(data)
+        info['numberRecordsFailed'] = int(failed.sum())
+        info['state'] = 'JobComplete'
+
+    # function to return one page of query results as CSV text, plus the locator of the next page
+    def getQueryResultsPage(self, jobId, maxRecords, locator):
+        with self.lock:
+            results = self.jobs[jobId]['results']
+        start = int(locator) if locator else 0
+        end = start + (maxRecords or self.pageSize)
+        page = results.iloc[start:end]
+        nextLocator = str(end) if end < len(results) else 'null'
+        return page.to_csv(index=False), nextLocator, len(page)
+
+# request handler that maps Bulk 2.0 endpoints onto a MockOrg (set as the server's org attribute)
+class MockBulkRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendBody(self, status, body, contentType='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        # like Salesforce, CSV results are compressed for clients that accept gzip
+        if contentType == 'text/csv' and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, mtime=0)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def readBody(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return data.decode('utf-8')
+
+    def route(self, method):
+        org = self.server.org
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        time.sleep(self.server.latency)
+
+        # admin endpoints of the mock itself (not counted as API requests)
+        if url.path == '/_stats':
+            with org.lock:
+                return self.sendBody(200, dict(org.requestCounts))
+        if url.path == '/_reset':
+            org.reset()
+            return self.sendBody(200, {})
+        if url.path == '/_seed':
+            df = pd.read_csv(StringIO(self.readBody()), dtype=str, keep_default_na=False)
+            return self.sendBody(200, {'records': org.seed(params['object'][0], df)})
+
+        if not url.path.startswith(JOBS_PATH):
+            return self.sendBody(404, [{'errorCode': 'NOT_FOUND', 'message': 'The requested resource does not exist'}])
+        parts = [part for part in url.path[len(JOBS_PATH):].split('/') if part]
+        kind = parts[0] if parts else ''
+        endpoint = method + ' ' + kind + ('/{id}' if len(parts) > 1 else '') + ('/' + parts[2] if len(parts) > 2 else '')
+        with org.lock:
+            org.requestCounts[endpoint] += 1
+
+        try:
+            if endpoint == 'POST query':
+                definition = json.loads(self.readBody())
+                return self.sendBody(200, org.createQueryJob(definition['query']))
+            if endpoint == 'GET query/{id}':
+                return self.sendBody(200, org.getJobInfo(parts[1]))
+            if endpoint == 'GET query/{id}/results':
+                maxRecords = int(params['maxRecords'][0]) if 'maxRecords' in params else None
+                locator = params['locator'][0] if 'locator' in params else None
+                page, nextLocator, count = org.getQueryResultsPage(parts[1], maxRecords, locator)
+                return self.sendBody(200, page, 'text/csv', {'Sforce-Locator': nextLocator, 'Sforce-NumberOfRecords': str(count)})
+            if endpoint == 'POST ingest':
+                return self.sendBody(200, org.createIngestJob(json.loads(self.readBody())))
+            if endpoint == 'PUT ingest/{id}/batches':
+                if org.addIngestData(parts[1], self.readBody()):
+                    return self.sendBody(201, '', 'text/plain')
+                return self.sendBody(409, [{'errorCode': 'INVALIDJOBSTATE', 'message': 'Job is not open'}])
+            if endpoint == 'PATCH ingest/{id}':
+                return self.sendBody(200, org.setIngestJobState(parts[1], json.loads(self.readBody())['state']))
+            if endpoint == 'GET ingest/{id}':
+                return self.sendBody(200, org.getJobInfo(parts[1]))
+            if endpoint in ('GET ingest/{id}/successfulResults', 'GET ingest/{id}/failedResults'):
+                with org.lock:
+                    results = org.jobs[parts[1]].get(parts[2], pd.DataFrame())
+                return self.sendBody(200, results.to_csv(index=False) if not results.empty else '', 'text/csv')
+        except KeyError:
+            return self.sendBody(404, [{'errorCode': 'NOT_FOUND', 'message': 'The requested resource does not exist'}])
+        except ValueError as e:
+            return self.sendBody(400, [{'errorCode': 'INVALIDJOB', 'message': str(e)}])
+
+        return self.sendBody(404, [{'errorCode': 'NOT_FOUND', 'message': 'Unsupported endpoint: ' + endpoint}])
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def do_PATCH(self):
+        self.route('PATCH')
+
+# function to start a mock Bulk 2.0 server in a background thread
+# latency is added to every request (seconds), processingTime is how long each job takes to complete
+# returns the server (call server.shutdown() to stop it) and the jobs uri to pass to functions.py
+def startMockBulkServer(port=0, latency=0.0, processingTime=0.5, pageSize=100000, failureRate=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockBulkRequestHandler)
+    server.daemon_threads = True
+    server.org = MockOrg(processingTime, pageSize, failureRate)
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:' + str(server.server_address[1]) + JOBS_PATH
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Salesforce Bulk 2.0 API.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--processing-time', type=float, default=0.5, help='seconds each job takes to complete')
+    parser.add_argument('--page-size', type=int, default=100000, help='query result rows per page when maxRecords is not given')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of ingested records that fail with UNABLE_TO_LOCK_ROW')
+    args = parser.parse_args()
+
+    server, uri = startMockBulkServer(args.port, args.latency, args.processing_time, args.page_size, args.failure_rate)
+    print('Mock Bulk 2.0 API listening, uri = ' + uri)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
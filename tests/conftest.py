@@ -0,0 +1,5 @@
+# tests import functions.py from the repository root
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+### TESTS: SPLITTING UPLOADS INTO INGEST JOBS
+
+import gzip
+
+import pandas as pd
+
+import functions
+
+# helper function to split CSV text and return the pieces as lists of data rows (header row removed)
+def splitRows(csvData, maxBytes, maxRows):
+    chunks = list(functions.splitCSVIntoChunks(csvData, maxBytes, maxRows))
+    return chunks, [chunk.split('\n', 1)[1] for chunk in chunks]
+
+def testSplitCSVRepeatsHeaderAndCapsRows():
+    csvData = 'Name,Weight__c\n' + ''.join('Rescue ' + str(i) + ',' + str(i) + '\n' for i in range(10))
+    chunks, rows = splitRows(csvData, 10**6, 4)
+
+    assert len(chunks) == 3
+    assert all(chunk.startswith('Name,Weight__c\n') for chunk in chunks)
+    assert [row.count('\n') for row in rows] == [4, 4, 2]
+    assert ''.join(rows) == csvData.split('\n', 1)[1]
+
+def testSplitCSVCapsBytes():
+    csvData = 'Name\n' + 'a' * 20 + '\n' + 'b' * 20 + '\n' + 'c' * 20 + '\n'
+    chunks, _ = splitRows(csvData, 50, 100)
+
+    # header + two 21-byte rows is 47 bytes, a third row would go over 50
+    assert len(chunks) == 2
+    assert all(len(chunk.encode('utf-8')) <= 50 for chunk in chunks)
+
+def testSplitCSVKeepsQuotedNewlinesInOneRow():
+    csvData = 'Name,Comments__c\nA,"first line\nsecond line"\nB,plain\nC,"one\ntwo\nthree"\n'
+    chunks, _ = splitRows(csvData, 10**6, 1)
+
+    assert len(chunks) == 3
+    parsed = [pd.read_csv(pd.io.common.StringIO(chunk)) for chunk in chunks]
+    assert [df['Name'].tolist() for df in parsed] == [['A'], ['B'], ['C']]
+    assert parsed[0]['Comments__c'][0] == 'first line\nsecond line'
+    assert parsed[2]['Comments__c'][0] == 'one\ntwo\nthree'
+
+def testSplitCSVWithoutTrailingNewline():
+    chunks, rows = splitRows('Name\nA\nB', 10**6, 1)
+
+    assert chunks == ['Name\nA\n', 'Name\nB']
+
+def testSplitCSVHeaderOnly():
+    assert list(functions.splitCSVIntoChunks('Name\n')) == []
+
+def testDataframeUploadBodiesHoldEveryRowOnce():
+    df = pd.DataFrame({'Name': ['Rescue ' + str(i) for i in range(25)], 'Comments__c': ['a\nb'] * 25})
+    bodies = list(functions.splitDataframeIntoUploadBodies(df, maxRows=10))
+
+    parts = [pd.read_csv(gzip.GzipFile(fileobj=body)) for body in bodies]
+    assert [len(part) for part in parts] == [10, 10, 5]
+    pd.testing.assert_frame_equal(pd.concat(parts, ignore_index=True), df)
+
+def testMergeIngestJobResultsKeepsOneFailedHeader():
+    results = [
+        {'jobIds': ['1'], 'numberRecordsProcessed': 2, 'numberRecordsFailed': 1, 'failedResults': '"sf__Id","sf__Error",Name\n"","ERR",A\n'},
+        {'jobIds': ['2'], 'numberRecordsProcessed': 3, 'numberRecordsFailed': 0, 'failedResults': ''},
+        {'jobIds': ['3'], 'numberRecordsProcessed': 1, 'numberRecordsFailed': 1, 'failedResults': '"sf__Id","sf__Error",Name\n"","ERR",B'}
+    ]
+    merged = functions.mergeIngestJobResults(results)
+
+    assert merged['jobIds'] == ['1', '2', '3']
+    assert merged['numberRecordsProcessed'] == 6
+    assert merged['numberRecordsFailed'] == 2
+    assert merged['failedResults'] == '"sf__Id","sf__Error",Name\n"","ERR",A\n"","ERR",B'
@@ -0,0 +1,28 @@
+### TESTS: RETRYING FAILED INGEST RECORDS
+
+import pandas as pd
+
+import functions
+
+def testRetryableErrorsAreRecognizedByCode():
+    failedDF = pd.DataFrame({'sf__Id': [''] * 4, 'sf__Error': [
+        'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record:--',
+        'REQUIRED_FIELD_MISSING:Required fields are missing: [Name]:Name --',
+        'SERVER_UNAVAILABLE:try again later:--',
+        'DUPLICATE_VALUE:duplicate value found: Volunteer_Id__c:--'
+    ]})
+
+    assert functions.isRetryableIngestError(failedDF).tolist() == [True, False, True, False]
+
+def testParseFailedResultsKeepsValuesAsUploaded():
+    failedDF = functions.parseFailedResults('"sf__Id","sf__Error",Volunteer_Id__c,Phone\n"","UNABLE_TO_LOCK_ROW:locked:--",007,\n')
+
+    assert failedDF['Volunteer_Id__c'].tolist() == ['007']
+    assert failedDF['Phone'].tolist() == ['']
+
+def testParseEmptyFailedResults():
+    failedDF = functions.parseFailedResults('')
+
+    assert failedDF.empty
+    assert list(failedDF.columns) == ['sf__Id', 'sf__Error']
+    assert not functions.isRetryableIngestError(failedDF).any()
@@ -0,0 +1,37 @@
+### TESTS: PARTITIONED EXTRACTION
+
+import functions
+
+def testAddSoqlConditionAddsWhereClause():
+    assert functions.addSoqlCondition('SELECT Id FROM Account', "Id < 'x'") == "SELECT Id FROM Account WHERE Id < 'x'"
+
+def testAddSoqlConditionKeepsTrailingClauses():
+    query = 'SELECT Id FROM Account ORDER BY Name LIMIT 5'
+    assert functions.addSoqlCondition(query, "Id < 'x'") == "SELECT Id FROM Account WHERE Id < 'x' ORDER BY Name LIMIT 5"
+
+def testAddSoqlConditionJoinsExistingConditions():
+    query = "SELECT Id FROM Account WHERE Name = 'A' LIMIT 5"
+    assert functions.addSoqlCondition(query, "Id < 'x'") == "SELECT Id FROM Account WHERE Id < 'x' AND Name = 'A' LIMIT 5"
+
+def testAddSoqlConditionBracketsOrConditions():
+    query = "SELECT Id FROM Account WHERE Name = 'A' OR Name = 'B'"
+    assert functions.addSoqlCondition(query, "Id < 'x'") == "SELECT Id FROM Account WHERE Id < 'x' AND (Name = 'A' OR Name = 'B')"
+
+def testAddSoqlConditionIgnoresKeywordsInLiterals():
+    query = "SELECT Id FROM Account WHERE Name = 'Bread OR Butter LIMIT 5 where'"
+    assert functions.addSoqlCondition(query, "Id < 'x'") == "SELECT Id FROM Account WHERE Id < 'x' AND Name = 'Bread OR Butter LIMIT 5 where'"
+
+def testAddSoqlConditionWithoutWhereIgnoresLiteralsAfterClauses():
+    query = "SELECT Id FROM Account ORDER BY Name"
+    assert functions.addSoqlCondition(query, "Name != 'a WHERE b'") == "SELECT Id FROM Account WHERE Name != 'a WHERE b' ORDER BY Name"
+
+def testMaskSoqlLiteralsKeepsLength():
+    query = "SELECT Id FROM Account WHERE Name = 'It\\'s LIMIT'"
+    masked = functions.maskSoqlLiterals(query)
+
+    assert len(masked) == len(query)
+    assert 'LIMIT' not in masked
+
+def testBuildRangeConditionsCoversEveryValue():
+    assert functions.buildRangeConditions('Id', ["'b'", "'d'"]) == ["Id < 'b'", "Id >= 'b' AND Id < 'd'", "Id >= 'd'"]
+    assert functions.buildRangeConditions('Id', []) == ['']
@@ -0,0 +1,56 @@
+### TESTS: RESCUE CHANGE TRACKING
+
+import pandas as pd
+
+import functions
+
+# helper function to build admin tool rescue rows
+def makeRescues(rows):
+    return pd.DataFrame(rows, columns=['rescue_id', 'food_type', 'rescue_state', ' total_weight '])
+
+def testRescueKeysDropWholeNumberDecimals():
+    keysDF = functions.getRescueKeys(pd.Series([123.0, '45', 'abc', 1.5]), ['Dairy', 'Produce', 'Meat', 'Bakery'])
+
+    assert keysDF['rescue_id'].tolist() == ['123', '45', 'abc', '1.5']
+    assert keysDF['food_type'].tolist() == ['Dairy', 'Produce', 'Meat', 'Bakery']
+
+def testFingerprintsChangeWithContent():
+    rescuesDF = makeRescues([[1, 'Dairy', 'Complete', 10], [2, 'Dairy', 'Complete', 10]])
+    changedDF = makeRescues([[1, 'Dairy', 'Complete', 10], [2, 'Dairy', 'Complete', 11]])
+
+    fingerprints = functions.computeRescueFingerprints(rescuesDF)
+    assert fingerprints[0] == functions.computeRescueFingerprints(changedDF)[0]
+    assert fingerprints[1] != functions.computeRescueFingerprints(changedDF)[1]
+
+def testClassifySplitsNewChangedAndUnchanged(tmp_path):
+    path = str(tmp_path / 'store.db')
+    sentDF = makeRescues([[1, 'Dairy', 'Complete', 10], [2, 'Dairy', 'Complete', 20]])
+    storedDF = functions.getRescueKeys(sentDF['rescue_id'], sentDF['food_type'])
+    storedDF['fingerprint'] = functions.computeRescueFingerprints(sentDF).values
+    storedDF['sf_id'] = ['a01A', 'a01B']
+    functions.saveRescueFingerprints(storedDF, path)
+
+    # rescue 1 is unchanged, rescue 2 has a new weight, rescue 3 is new
+    rescuesDF = makeRescues([[1, 'Dairy', 'Complete', 10], [2, 'Dairy', 'Complete', 25], [3, 'Dairy', 'Complete', 5]])
+    newDF, changedDF, fingerprintsDF = functions.classifyFoodRescues(rescuesDF, None, None, path)
+
+    assert newDF['rescue_id'].tolist() == [3]
+    assert changedDF['rescue_id'].tolist() == [2]
+    assert changedDF['Id'].tolist() == ['a01B']
+    assert sorted(fingerprintsDF['rescue_id']) == ['2', '3']
+
+def testRecordedRescuesAreNotSentAgain(tmp_path):
+    path = str(tmp_path / 'store.db')
+    functions.saveRescueFingerprints(pd.DataFrame({'rescue_id': ['0'], 'food_type': ['Meat'], 'fingerprint': ['x'], 'sf_id': ['a01Z']}), path)
+    rescuesDF = makeRescues([[0, 'Meat', 'Complete', 1], [1, 'Dairy', 'Complete', 10], [1, 'Produce', 'Complete', 5]])
+
+    newDF, changedDF, fingerprintsDF = functions.classifyFoodRescues(rescuesDF, None, None, path)
+    assert len(newDF) == 2
+
+    # only the rows Salesforce accepted are recorded
+    result = {'successfulResults': pd.DataFrame({'sf__Id': ['a01C'], 'sf__Created': [True], 'Rescue_Id__c': [1.0], 'Food_Type__c': ['Dairy']})}
+    functions.recordSentFoodRescues(result, fingerprintsDF, path)
+
+    newDF, changedDF, _ = functions.classifyFoodRescues(rescuesDF, None, None, path)
+    assert newDF['food_type'].tolist() == ['Produce']
+    assert changedDF['rescue_id'].tolist() == [0]
@@ -0,0 +1,101 @@
+### TESTS: RUN JOURNAL
+
+import json
+
+import pandas as pd
+import pytest
+
+import functions
+
+# every test journals to its own file, and stops journaling afterwards so no state leaks into other tests
+@pytest.fixture
+def journalPath(tmp_path):
+    yield str(tmp_path / 'journal.json')
+    functions.stopRunJournal()
+
+# helper function to build admin tool rescue rows
+def makeRescues(rows):
+    return pd.DataFrame(rows, columns=['rescue_id', 'food_type', 'rescue_state', ' total_weight '])
+
+def testJournalIsSavedAndLoaded(journalPath):
+    functions.startRunJournal(journalPath)
+    functions.recordJournaledStage('donors', 'hash1')
+    functions.recordJournaledIngestJob('payload1', '750A', 'Account', 'insert', 'UploadComplete')
+    functions.recordJournaledJobStates({'750A': {'state': 'JobComplete'}})
+    functions.stopRunJournal()
+
+    with open(journalPath) as f:
+        assert json.load(f)['jobs']['payload1'] == {'jobId': '750A', 'object': 'Account', 'operation': 'insert', 'state': 'JobComplete'}
+
+    functions.startRunJournal(journalPath)
+    assert functions.isStageJournaled('donors', 'hash1')
+    assert not functions.isStageJournaled('donors', 'hash2')
+    assert not functions.isStageJournaled('partners', 'hash1')
+    assert functions.getResumableIngestJobIds('Account') == ['750A']
+    assert functions.getResumableIngestJobIds('Contact') == []
+
+    # a job is re-attached to once, and stays in the journal
+    assert functions.findJournaledIngestJob('payload1') == '750A'
+    assert functions.findJournaledIngestJob('payload1') is None
+    functions.stopRunJournal()
+    with open(journalPath) as f:
+        assert list(json.load(f)['jobs']) == ['payload1']
+
+def testJournalIsDiscardedWithoutResume(journalPath):
+    functions.startRunJournal(journalPath)
+    functions.recordJournaledStage('donors', 'hash1')
+    functions.stopRunJournal()
+
+    functions.startRunJournal(journalPath, resume=False)
+    assert not functions.isStageJournaled('donors', 'hash1')
+
+def testFinishedJournalIsDeleted(journalPath, tmp_path):
+    functions.startRunJournal(journalPath)
+    functions.stopRunJournal(delete=True)
+    assert list(tmp_path.iterdir()) == []
+
+def testPendingFingerprintsAreReplaced(tmp_path):
+    path = str(tmp_path / 'store.db')
+    assert functions.loadPendingRescueFingerprints(path).empty
+
+    functions.savePendingRescueFingerprints(pd.DataFrame({'rescue_id': ['1', '2'], 'food_type': ['Dairy', 'Meat'], 'fingerprint': ['a', 'b']}), path)
+    functions.savePendingRescueFingerprints(pd.DataFrame({'rescue_id': ['3'], 'food_type': ['Dairy'], 'fingerprint': ['c'], 'Id': [None]}), path)
+
+    pendingDF = functions.loadPendingRescueFingerprints(path)
+    assert pendingDF.to_dict('records') == [{'rescue_id': '3', 'food_type': 'Dairy', 'fingerprint': 'c'}]
+
+def testResumeWithChangedExportSendsOnlyNewAndChangedRescues(tmp_path, monkeypatch):
+    path = str(tmp_path / 'store.db')
+    functions.saveRescueFingerprints(pd.DataFrame({'rescue_id': ['0'], 'food_type': ['Meat'], 'fingerprint': ['x'], 'sf_id': ['a01Z']}), path)
+
+    # the earlier run sent rescues 1 and 2, but stopped before recording them
+    sentDF = makeRescues([[1, 'Dairy', 'Complete', 10], [2, 'Dairy', 'Complete', 20]])
+    _, _, fingerprintsDF = functions.classifyFoodRescues(sentDF, None, None, path)
+    functions.savePendingRescueFingerprints(fingerprintsDF, path)
+    successfulResults = pd.DataFrame({'sf__Id': ['a01A', 'a01B'], 'sf__Created': [True, True], 'Rescue_Id__c': [1.0, 2.0], 'Food_Type__c': ['Dairy', 'Dairy']})
+    monkeypatch.setattr(functions, 'getSalesforceIngestJobSuccessfulResults', lambda jobId, session, uri: successfulResults)
+    functions.recordJournaledFoodRescues(['750R'], None, None, path)
+
+    # since then, rescue 2 changed and rescue 3 was added
+    rescuesDF = makeRescues([[0, 'Meat', 'Complete', 1], [1, 'Dairy', 'Complete', 10], [2, 'Dairy', 'Complete', 25], [3, 'Dairy', 'Complete', 5]])
+    newDF, changedDF, _ = functions.classifyFoodRescues(rescuesDF, None, None, path)
+
+    assert newDF['rescue_id'].tolist() == [3]
+    assert sorted(changedDF['rescue_id']) == [0, 2]
+    assert changedDF.set_index('rescue_id').loc[2, 'Id'] == 'a01B'
+
+def testResumeReadsAccountsSentByEarlierRunAgain(journalPath, monkeypatch):
+    functions.startRunJournal(journalPath)
+    functions.recordJournaledIngestJob('payload1', '750A', 'Account', 'insert', 'JobComplete')
+    functions.stopRunJournal()
+    functions.startRunJournal(journalPath)
+
+    reads = []
+    refreshedDF = pd.DataFrame({'Id': ['001A', '001B'], 'Name': ['Old Donor', 'Donor Sent Earlier']})
+    monkeypatch.setattr(functions, 'getDataframeFromSnapshot', lambda objectType, session, uri, fields: reads.append((objectType, fields)) or refreshedDF)
+
+    accountsDF = pd.DataFrame({'Id': ['001A'], 'Name': ['Old Donor']})
+    contactsDF = pd.DataFrame({'Id': ['003A'], 'Name': ['Volunteer']})
+    assert functions.refreshJournaledRecords(accountsDF, 'Account', None, None) is refreshedDF
+    assert functions.refreshJournaledRecords(contactsDF, 'Contact', None, None) is contactsDF
+    assert reads == [('Account', ['Id', 'Name'])]
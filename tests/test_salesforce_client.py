@@ -0,0 +1,75 @@
+### TESTS: SALESFORCE API CLIENT
+
+from io import BytesIO
+import threading
+import time
+
+import requests
+
+import functions
+
+# helper function to build a response with a status code and body
+def makeResponse(statusCode, text=''):
+    response = requests.Response()
+    response.status_code = statusCode
+    response._content = text.encode('utf-8')
+    response.raw = BytesIO()
+    return response
+
+# helper function to make every request of a client answer with the given status codes in turn
+# returns the list the methods of the sent requests are recorded in
+def answerWith(monkeypatch, statusCodes):
+    sent = []
+    def request(self, method, url, **kwargs):
+        sent.append(method)
+        return makeResponse(statusCodes[min(len(sent), len(statusCodes)) - 1])
+    monkeypatch.setattr(requests.Session, 'request', request)
+    monkeypatch.setattr(functions.random, 'uniform', lambda low, high: 0)
+    return sent
+
+def testPostIsNotRetriedOnGatewayErrors(monkeypatch):
+    for statusCode in (500, 502, 504):
+        sent = answerWith(monkeypatch, [statusCode, 200])
+        response = functions.SalesforceClient('session').post('https://example.com/jobs/ingest')
+
+        assert response.status_code == statusCode
+        assert sent == ['POST']
+
+def testPostIsRetriedWhenTurnedAway(monkeypatch):
+    for statusCode in (429, 503):
+        sent = answerWith(monkeypatch, [statusCode, 200])
+        response = functions.SalesforceClient('session').post('https://example.com/jobs/ingest')
+
+        assert response.status_code == 200
+        assert sent == ['POST', 'POST']
+
+def testGetIsRetriedOnGatewayErrors(monkeypatch):
+    sent = answerWith(monkeypatch, [502, 504, 200])
+    response = functions.SalesforceClient('session').get('https://example.com/jobs/query')
+
+    assert response.status_code == 200
+    assert sent == ['GET', 'GET', 'GET']
+
+def testExpiredSessionLogsInOnceForAllThreads(monkeypatch):
+    logins = []
+    def login():
+        logins.append(threading.current_thread().name)
+        time.sleep(0.2)
+        return 'new session'
+    def request(self, method, url, **kwargs):
+        if kwargs['headers']['Authorization'] == 'Bearer old session':
+            return makeResponse(401, '[{"errorCode": "INVALID_SESSION_ID"}]')
+        return makeResponse(200)
+    monkeypatch.setattr(requests.Session, 'request', request)
+
+    client = functions.SalesforceClient('old session', login)
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(client.get('https://example.com'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(logins) == 1
+    assert [response.status_code for response in responses] == [200] * 4
+    assert client.loginDone is None
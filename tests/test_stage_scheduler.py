@@ -0,0 +1,54 @@
+### TESTS: STAGE SCHEDULER
+
+import sys
+import time
+
+import functions
+
+def succeed():
+    pass
+
+def fail():
+    sys.exit()
+
+def slowFail():
+    time.sleep(0.2)
+    sys.exit()
+
+def testSkippedStageNamesEveryFailedDependency():
+    outcomes = functions.runStages({
+        'donors': (fail, []),
+        'partners': (slowFail, []),
+        'volunteers': (succeed, []),
+        'rescues': (succeed, ['donors', 'partners', 'volunteers'])
+    })
+
+    assert [outcomes[name]['status'] for name in ('donors', 'partners', 'volunteers', 'rescues')] == ['failed', 'failed', 'ok', 'skipped']
+    assert outcomes['rescues']['error'] == 'depends on unsuccessful stage(s): donors, partners'
+
+def testSkipsCascadeAndNameUnknownDependencies():
+    outcomes = functions.runStages({
+        'a': (fail, []),
+        'b': (succeed, ['a', 'missing']),
+        'c': (succeed, ['b'])
+    })
+
+    assert outcomes['b']['error'] == 'depends on unsuccessful stage(s): a; unknown dependencies: missing'
+    assert outcomes['c'] == {'status': 'skipped', 'error': 'depends on unsuccessful stage(s): b', 'seconds': 0}
+
+def testCompletedStagesCountAsSucceeded():
+    ran = []
+    outcomes = functions.runStages({
+        'a': (lambda: ran.append('a'), []),
+        'b': (lambda: ran.append('b'), ['a'])
+    }, completed=['a'])
+
+    assert ran == ['b']
+    assert outcomes['a']['status'] == 'done'
+    assert outcomes['b']['status'] == 'ok'
+
+def testCircularDependenciesAreSkipped():
+    outcomes = functions.runStages({'a': (succeed, ['b']), 'b': (succeed, ['a'])})
+
+    assert outcomes['a']['status'] == outcomes['b']['status'] == 'skipped'
+    assert outcomes['a']['error'] == 'circular dependencies between stages: a, b'